@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+"""
+Aggregation of small messages into full LoRa frames.
+
+An aggregated payload is MARKER followed by messages, each prefixed by
+its length in one byte:
+
+    MARKER len1 message1 len2 message2 ...
+
+Aggregator fills a payload up to the largest one the current spreading
+factor allows and sends it when the next message would not fit, or when
+the oldest message waiting has been held for max_age seconds. unpack()
+splits a received payload back into messages.
+
+    a = Aggregator(e, max_age=2)
+    a.add(b'temperature 21.5')
+    for packet, message in messages(e):
+        ...
+"""
+
+import sys
+import threading
+import time
+from ebi import EBI
+import lora
+
+MARKER = 0xA7
+MAX_MESSAGE = 0xFF
+
+def pack(messages):
+    "build an aggregated payload out of messages"
+    payload = bytearray([MARKER])
+    for message in messages:
+        if len(message) > MAX_MESSAGE:
+            raise ValueError(f"message of {len(message)} bytes, at most {MAX_MESSAGE} fit")
+        payload.append(len(message))
+        payload += message
+    return bytes(payload)
+
+def unpack(payload):
+    "split an aggregated payload into its messages"
+    if not payload or payload[0] != MARKER:
+        raise ValueError("not an aggregated payload")
+    messages = []
+    offset, end = 1, len(payload)
+    while offset < end:
+        length = payload[offset]
+        if offset + 1 + length > end:
+            raise ValueError(f"message truncated at offset {offset}")
+        messages.append(bytes(payload[offset + 1:offset + 1 + length]))
+        offset += 1 + length
+    return messages
+
+def messages(ebi, protocol=0, timeout=None):
+    "iterate over (packet, message) for every message of the aggregated packets received"
+    for packet in ebi.packets(protocol, timeout):
+        try:
+            parts = unpack(packet.data)
+        except ValueError:
+            continue
+        for message in parts:
+            yield packet, message
+
+class Aggregator:
+    """Packs messages into as few send_data calls as possible
+
+send is the function transmitting a payload, ebi.send_data by default
+(TxScheduler.send to also respect the duty cycle); send_kwargs are
+passed to it. max_size defaults to the largest payload of the current
+spreading factor. on_sent, if given, is called with the send result and
+the list of messages it carried."""
+    def __init__(self, ebi, max_age=1.0, max_size=None, send=None, on_sent=None, **send_kwargs):
+        self.ebi = ebi
+        self.max_age = max_age
+        self.max_size = max_size
+        self.send = send or ebi.send_data
+        self.on_sent = on_sent
+        self.send_kwargs = send_kwargs
+        self.messages = 0
+        self.frames = 0
+        self._pending = []
+        self._size = 1
+        self._deadline = None
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._timer = threading.Thread(target=self._age_loop, name="aggregator", daemon=True)
+        self._timer.start()
+    def close(self):
+        "send what is pending and stop the age timer"
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._timer.join()
+        self.flush()
+    def limit(self):
+        "largest aggregated payload"
+        if self.max_size:
+            return self.max_size
+        sf = self.ebi.operating_channel().get('spreading_factor', 7)
+        # the codec header is added even when the payload does not compress
+        return lora.max_payload(sf) - (1 if self.ebi.codec else 0)
+    def add(self, message):
+        "queue a message, sending the pending ones first if it does not fit with them"
+        message = bytes(message)
+        limit = self.limit()
+        if len(message) > min(MAX_MESSAGE, limit - 2):
+            raise ValueError(f"message of {len(message)} bytes does not fit a {limit} byte payload")
+        with self._send_lock:
+            with self._cond:
+                full = self._take() if self._size + 1 + len(message) > limit else None
+                self._pending.append(message)
+                self._size += 1 + len(message)
+                if self._deadline is None:
+                    self._deadline = time.monotonic() + self.max_age
+                    self._cond.notify()
+            if full:
+                self._transmit(full)
+    def flush(self):
+        "send the pending messages now"
+        # the send lock keeps payloads going out in the order messages came
+        with self._send_lock:
+            with self._cond:
+                pending = self._take()
+            if pending:
+                return self._transmit(pending)
+        return None
+    def _take(self):
+        pending, self._pending, self._size, self._deadline = self._pending, [], 1, None
+        return pending
+    def _transmit(self, pending):
+        result = self.send(pack(pending), **self.send_kwargs)
+        self.messages += len(pending)
+        self.frames += 1
+        if self.on_sent:
+            self.on_sent(result, pending)
+        return result
+    def _age_loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and (
+                    self._deadline is None or self._deadline > time.monotonic()
+                ):
+                    timeout = self._deadline - time.monotonic() if self._deadline else None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
+
+if __name__ == "__main__":
+    DEVICE = "/dev/ttyUSB0"
+    if len(sys.argv) > 1:
+        DEVICE = sys.argv[1]
+    e = EBI(DEVICE, lazy=True)
+    print("CONFIG:", e.apply_config(channel=(1,7,0,1), start=True))
+    a = Aggregator(e, on_sent=lambda result, sent: print(f"{len(sent)} messages: {result}"))
+    for INDEX in range(40):
+        a.add(f"reading {INDEX} {time.time():.3f}".encode())
+        time.sleep(0.1)
+    a.close()
+    e.close()
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+"""
+asyncio implementation for EBI protocol.
+"""
+
+import asyncio
+import sys
+import time
+import serial
+from ebi import EBI, RxPacket, FrameDecoder, FrameEncoder, DuplicateFilter
+from ebi import ChecksumError, UnexpectedResponse, Timeout
+
+class AsyncEBI:
+    """EBI protocol class driven by an asyncio event loop"""
+    hex = EBI.hex
+    corrupt = EBI.corrupt
+    discarded = EBI.discarded
+    duplicates = EBI.duplicates
+    RESYNC_DELAY = 0.2
+    debug = EBI.debug
+    _data_request = staticmethod(EBI._data_request)
+    def __init__(
+        self, dev, debug=False, timeout=5, queue_size=256, tap=None, codec=None, dedup=None
+    ):
+        self.tap = tap
+        self.tap_error = None
+        self.codec = codec
+        self.dedup = DuplicateFilter(dedup) if dedup else None
+        if debug:
+            self.debug = debug
+        self.dev = dev
+        self.timeout = timeout
+        self.state = {}
+        self.dropped = 0
+        self.malformed = 0
+        self.ser = None
+        self.rx = None
+        self.notifications = None
+        self._loop = None
+        self._lock = None
+        self._waiters = {}
+        self._decoder = FrameDecoder(on_corrupt=self._corrupt)
+        self._resync = None
+        self._encoder = FrameEncoder()
+        self._queue_size = queue_size
+    async def connect(self):
+        "open the port, hook it into the running loop and query the device"
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+        self.rx = asyncio.Queue(self._queue_size)
+        self.notifications = asyncio.Queue(self._queue_size)
+        self.ser = serial.Serial(self.dev, baudrate=9600, timeout=0)
+        self._loop.add_reader(self.ser.fileno(), self._on_readable)
+        self.state = await self.device_info()
+        self.state.update(await self.device_state())
+        self.state.update(await self.firmware_version())
+        return self
+    async def close(self):
+        "detach from the loop and close the port"
+        if self.ser is None:
+            return
+        self._loop.remove_reader(self.ser.fileno())
+        if self._resync is not None:
+            self._resync.cancel()
+        self.ser.close()
+        self.ser = None
+        for waiter in self._waiters.values():
+            if not waiter.done():
+                waiter.cancel()
+        self._waiters.clear()
+        # wake up whoever waits for a packet or notification
+        self._put(self.rx, None)
+        self._put(self.notifications, None)
+    async def __aenter__(self):
+        return await self.connect()
+    async def __aexit__(self, *exc):
+        await self.close()
+    def _on_readable(self):
+        data = self.ser.read(self.ser.in_waiting or 1)
+        if not data:
+            return
+        self._handle(self._decoder.feed(data), time.time())
+        if self._resync is not None:
+            self._resync.cancel()
+            self._resync = None
+        if self._decoder.buffer:
+            # a partial frame the line never completes is junk
+            self._resync = self._loop.call_later(
+                self.RESYNC_DELAY, lambda: self._handle(self._decoder.resync())
+            )
+    def _handle(self, frames, stamp=None):
+        for frame in frames:
+            if self.tap:
+                self._tap('<', frame)
+            try:
+                self._dispatch(frame[2:-1], stamp)
+            except Exception: # pylint: disable=broad-except
+                # one bad frame must not break the loop's reader callback
+                self.malformed += 1
+    _tap = EBI._tap
+    def _dispatch(self, frame, stamp=None):
+        if not frame or (frame[0] == 0x84 and len(frame) < 2):
+            self.malformed += 1
+            return
+        waiter = self._waiters.pop(frame[0], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(frame)
+            return
+        if frame[0] == 0x84:
+            self.state['state'] = EBI.DEVICE_STATE.get(frame[1], None)
+        if frame[0] == 0xE0:
+            if self.dedup is None or not self.dedup.check(frame):
+                self._put(self.rx, (time.time() if stamp is None else stamp, frame))
+        else:
+            self._put(self.notifications, frame)
+    def _put(self, queue, item):
+        if queue.full():
+            # drop the oldest frame to make room
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(item)
+    def _corrupt(self, frame):
+        waiter = self._waiters.pop(frame[2], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(ChecksumError(f"bad BCC in frame {self.hex(frame)}"))
+    def _expect(self, code):
+        waiter = self._loop.create_future()
+        self._waiters[code] = waiter
+        return waiter
+    async def _wait(self, code, waiter, timeout=None):
+        try:
+            return await asyncio.wait_for(
+                waiter, self.timeout if timeout is None else timeout
+            )
+        except asyncio.TimeoutError:
+            raise Timeout(f"no frame {code:#04x} from {self.dev}") from None
+        finally:
+            if self._waiters.get(code) is waiter:
+                del self._waiters[code]
+    async def _transmit(self, command, *parts, timeout=None):
+        packet = self._encoder.encode(command, *parts)
+        if self.tap:
+            self._tap('>', packet)
+        code = command[0] | 0x80
+        waiter = self._expect(code)
+        self.ser.write(packet)
+        ans = await self._wait(code, waiter, timeout)
+        if ans[0] != code:
+            raise UnexpectedResponse(f"expected {code:#04x}, got {self.hex(ans)}")
+        return ans[1:]
+    async def _send(self, command, *parts, timeout=None):
+        async with self._lock:
+            return await self._transmit(command, *parts, timeout=timeout)
+    async def _get(self, code, timeout=None):
+        "query a COMMANDS entry and decode its answer"
+        command = EBI.COMMANDS[code]
+        return command.decode(await self._send(command.prefix, timeout=timeout))
+    async def _set(self, code, **values):
+        "write the request of a COMMANDS entry; returns its status"
+        command = EBI.COMMANDS[code]
+        ans = await self._send(command.prefix, command.request.encode(values))
+        return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
+    async def device_info(self):
+        "get device info (uuid, type, protocol)"
+        return await self._get(0x01)
+    async def device_state(self):
+        "get device state"
+        return await self._get(0x04)
+    async def reset(self):
+        "reset device"
+        async with self._lock:
+            waiter = self._expect(0x84)
+            command = EBI.COMMANDS[0x05]
+            ans = command.decode(await self._transmit(command.prefix))
+            boot = await self._wait(0x84, waiter, 3)
+        if boot[0] != 0x84:
+            raise UnexpectedResponse(f"expected boot notification, got {self.hex(boot)}")
+        self.state['state'] = EBI.DEVICE_STATE.get(boot[1], None)
+        ans['boot_state'] = EBI.DEVICE_STATE.get(boot[1], None)
+        return ans
+    async def firmware_version(self):
+        "get firmware version"
+        return await self._get(0x06)
+    async def output_power(self, power=None):
+        "get or set output power"
+        if power is not None:
+            return await self._set(0x10, power=int(power) % 256)
+        return await self._get(0x10)
+    async def operating_channel(
+        self, channel=None, spreading_factor=None, bandwidth=None, coding_rate=None
+    ):
+        "get or set radio modulation parameter"
+        if channel in EBI.LORA_CHANNEL and spreading_factor in EBI.LORA_SPREADING_FACTOR and \
+            bandwidth in EBI.LORA_BANDWIDTH and coding_rate in EBI.LORA_CODING_RATE:
+            return await self._set(
+                0x11, channel=channel, spreading_factor=spreading_factor,
+                bandwidth=bandwidth, coding_rate=coding_rate
+            )
+        return await self._get(0x11)
+    async def energy_save(self, policy=None):
+        "get or set energy save policy"
+        if policy in EBI.MODULE_SLEEP_POLICY:
+            return await self._set(0x13, policy=policy)
+        return await self._get(0x13)
+    async def network_address(self, address=None):
+        "get or set network address"
+        if address and len(address) in [2,4]:
+            return await self._set(0x21, address=address)
+        return await self._get(0x21)
+    async def network_identifier(self, identifier=None):
+        "get or set network identifier"
+        if identifier and len(identifier) in [2,4]:
+            return await self._set(0x22, identifier=identifier)
+        return await self._get(0x22)
+    async def network_preference(self, protocol=None, auto_join=None, adr=None):
+        "get or set network preference"
+        if protocol in [0,1] and auto_join in [0,1] and adr in [0,1]:
+            return await self._set(0x25, preference=(protocol << 7) + (auto_join << 6) + (adr << 5))
+        return await self._get(0x25)
+    async def network_stop(self):
+        "stop network"
+        return await self._get(0x30)
+    async def network_start(self):
+        "start network"
+        return await self._get(0x31, timeout=3)
+    async def send_data(self, payload, protocol=0, dst=None, port=1):
+        "send data"
+        if self.codec:
+            payload = self.codec.encode(payload)
+        command = EBI.COMMANDS[0x50]
+        ans = await self._send(command.prefix, self._data_request(payload, protocol, dst, port))
+        return command.decode(ans)
+    async def ieee_address(self, mac=None):
+        "get or set IEEE address"
+        if mac:
+            assert len(mac) == 8
+            return await self._set(0x7E, mac=mac)
+        return await self._get(0x7E)
+    async def notification(self, code=None):
+        "get the next queued notification, only those with code if given; None once closed"
+        while True:
+            ans = await self._get_frame(self.notifications)
+            if ans is None or code is None or ans[0] == code:
+                return ans
+    async def _get_frame(self, queue):
+        ans = await queue.get()
+        if ans is None:
+            # closed: leave the marker for the next one waiting
+            queue.put_nowait(None)
+        return ans
+    async def receive(self, protocol=0, timeout=None):
+        "listen for data; None on timeout or once closed"
+        try:
+            ans = await asyncio.wait_for(self._get_frame(self.rx), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if ans is None:
+            return None
+        stamp, frame = ans
+        return RxPacket(frame, protocol, self.codec, stamp)
+    async def packets(self, protocol=0):
+        "iterate over received packets until closed"
+        while True:
+            packet = await self.receive(protocol)
+            if packet is None:
+                return
+            yield packet
+
+async def main(device):
+    "demo: configure the module and print received packets"
+    async with AsyncEBI(device, debug=True) as e:
+        print("RESET:", await e.reset())
+        print("DEVICE STATE", e.state)
+        print("NETWORK STOP:", await e.network_stop())
+        print("OPERATING CHANNEL:", await e.operating_channel())
+        print("NETWORK START:", await e.network_start())
+        async for pkt in e.packets():
+            print(pkt)
+
+if __name__ == "__main__":
+    DEVICE = "/dev/ttyUSB0"
+    if len(sys.argv) > 1:
+        DEVICE = sys.argv[1]
+    try:
+        asyncio.run(main(DEVICE))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+"""
+EBI benchmarks, run against a scripted pty stand-in of the module.
+
+    bench.py                           print every result
+    bench.py --json results.json       also save them as JSON
+    bench.py --compare baseline.json   fail on regressions against a saved run
+
+Micro benchmarks time framing and decoding per frame, macro benchmarks
+time whole commands and RX streams through a pty loopback.
+"""
+
+import argparse
+import json
+import os
+import pty
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import tty
+from ebi import EBI, RxPacket, TxResult, FrameDecoder, FrameEncoder, DuplicateFilter
+from metrics import Metrics
+from aggregate import pack
+from compress import Codec, train
+from store import PacketStore
+from mux import RxRing, RingReader
+import lora
+
+class ScriptedModule:
+    """pty stand-in replaying canned module responses"""
+    RESPONSES = {
+        0x01: [[0x81, 0x50, 0x55, 0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07]],
+        0x04: [[0x84, 0x20]],
+        0x05: [[0x85, 0x00], [0x84, 0x10]],
+        0x06: [[0x86, 0x01, 0x02, 0x03, 0x04]],
+        0x10: [[0x90, 0x0E]],
+        0x11: [[0x91, 0x01, 0x07, 0x00, 0x01]],
+        0x13: [[0x93, 0x00]],
+        0x21: [[0xA1, 0x00, 0x01]],
+        0x22: [[0xA2, 0x00, 0x01]],
+        0x25: [[0xA5, 0x00]],
+        0x30: [[0xB0, 0x00]],
+        0x31: [[0xB1, 0x00]],
+        0x50: [[0xD0, 0x00, 0x00, 0xFF, 0xC0]],
+        0x7E: [[0xFE, 0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07]],
+    }
+    def __init__(self, responses=None, latency=0.015):
+        self.responses = dict(ScriptedModule.RESPONSES)
+        self.responses.update(responses or {})
+        self.latency = latency
+        self.requests = 0
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._encoder = FrameEncoder()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+    def close(self):
+        "close both pty ends"
+        os.close(self._master)
+        os.close(self._slave)
+    def write(self, body):
+        "push an unsolicited frame to the host"
+        os.write(self._master, self._encoder.encode(body))
+    def inject(self, data):
+        "push raw bytes to the host"
+        os.write(self._master, data)
+    def _loop(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            for frame in decoder.feed(data):
+                self.requests += 1
+                if self.latency:
+                    time.sleep(self.latency)
+                for body in self.responses.get(frame[2], []):
+                    self.write(body)
+
+class Baseline:
+    """The original EBI's eager decoding, the reference of the codec benchmarks"""
+    @staticmethod
+    def hexstr(arr):
+        "format arr as hexstring"
+        try:
+            _hex = bytes(arr).hex(":")
+        except TypeError:
+            _hex = bytes(arr).hex()
+        return _hex
+    def hex(self, arr):
+        "print arr as hexstring"
+        return Baseline.hexstr(arr)
+    def device_info(self, ans):
+        "device_info answer"
+        return {
+            'ebi_protocol': EBI.PROTOCOL.get(ans[0], None),
+            'embit_module': EBI.EMBIT_MODULE.get(ans[1], None),
+            'uuid': self.hex(ans[2:]),
+        }
+    def receive(self, ans, protocol=0):
+        "received packet"
+        def signed(num, bits):
+            if num & (1 <<(bits -1)):
+                return num - (1 << bits)
+            return num
+        packet = {
+            'options': self.hex(ans[1:3]),
+            'rssi': signed((ans[3] << 8) + ans[4], 16),
+        }
+        if protocol == 0:
+            packet['src'] = self.hex(ans[5:7])
+            packet['dst'] = self.hex(ans[7:9])
+            packet['data'] = bytes(ans[9:])
+        elif protocol == 1:
+            packet['port'] = ans[5]
+            packet['data'] = bytes(ans[6:])
+        return packet
+    def send_data(self, ans):
+        "send_data answer"
+        result = {
+            'status':          EBI.STATUS.get(ans[0],ans[0]),
+            'retries':         ans[1],
+            'RSSI':            (ans[2] << 8) + ans[3],
+        }
+        if result['status'] == 'Success':
+            if len(ans) >= 6:
+                result['tx_channel_mask'] = (ans[4] << 8) + ans[5]
+            if len(ans) >= 7:
+                result['tx_datarate_mask'] = ans[6]
+            if len(ans) >= 8:
+                result['tx_power'] = ans[7]
+            if len(ans) == 12:
+                result['waiting_time'] = (ans[8] << 24) + (ans[9] << 16) + (ans[10] << 8) + ans[11]
+        return result
+
+def bench_startup(rounds=10, latency=0.015):
+    "time EBI construction: eager, lazy and with a warm identity cache"
+    module = ScriptedModule(latency=latency)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = os.path.join(tmp, 'identity.json')
+        EBI(module.port, debug=False, identity_cache=cache).close()
+        for name, kwargs in (
+            ('eager', {}),
+            ('lazy', { 'lazy': True }),
+            ('identity_cache', { 'identity_cache': cache }),
+        ):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                EBI(module.port, debug=False, **kwargs).close()
+            results[f"{name} ms"] = (time.perf_counter() - start) / rounds * 1000
+    module.close()
+    return results
+
+def bench_packets(count=100000):
+    """decode cost and memory of RxPacket against the original eager decoding
+
+dict is an RxPacket turned into a dict, as callers wanting one do."""
+    # frames come out of the decoder as views, each packet copies its own
+    frame = memoryview(
+        bytes([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, 0x01, 0xFF, 0xFF] + list(range(20)))
+    )
+    baseline = Baseline()
+    results = {}
+    for name, decode in (
+        ('baseline', lambda: baseline.receive(frame)),
+        ('dict', lambda: dict(RxPacket(frame))),
+        ('RxPacket', lambda: RxPacket(frame)),
+    ):
+        start = time.perf_counter()
+        for _ in range(count):
+            packet = decode()
+            _ = packet['data'], packet['src']
+        results[f"{name} decode us"] = (time.perf_counter() - start) / count * 1e6
+        tracemalloc.start()
+        packets = [decode() for _ in range(count // 10)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[f"{name} bytes/packet"] = size / len(packets)
+    return results
+
+def bench_metrics(count=100000):
+    "per-frame cost of the Metrics tap on a command/response/RX mix"
+    encoder = FrameEncoder()
+    frames = [
+        bytes(encoder.encode([0x50, 0x00, 0x00, 0xFF, 0xFF], list(range(20)))),
+        bytes(encoder.encode([0xD0, 0x00, 0x01, 0xFF, 0xC0])),
+        bytes(encoder.encode([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, 0x01, 0xFF, 0xFF],
+                             list(range(20)))),
+    ]
+    directions = ('>', '<', '<')
+    metrics = Metrics()
+    start = time.perf_counter()
+    for _ in range(count // len(frames)):
+        for direction, frame in zip(directions, frames):
+            metrics(direction, '/dev/ttyUSB0', frame)
+    per_frame = (time.perf_counter() - start) / (count // len(frames) * len(frames))
+    # a 30 byte frame takes about 31 ms on the wire at 9600 baud
+    return { 'tap us/frame': per_frame * 1e6, 'share of wire time %': per_frame / 0.031 * 100 }
+
+def per_call(function, count, repeat=3):
+    "average duration of function(), in microseconds, best of repeat runs"
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return best / count * 1e6
+
+def bench_framing(count=100000):
+    "frame construction as in _send, and parsing with BCC check as in the reader"
+    encoder = FrameEncoder()
+    header, payload = [0x00, 0x00, 0xFF, 0xFF], bytes(range(20))
+    frames = [
+        bytes(encoder.encode([0xD0, 0x00, 0x00, 0xFF, 0xC0])),
+        bytes(encoder.encode([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, 0x01, 0xFF, 0xFF], payload)),
+    ] * 50
+    chunk = b''.join(frames)
+    decoder = FrameDecoder()
+    decode = per_call(lambda: decoder.feed(chunk), count // len(frames))
+    return {
+        'encode us/frame': per_call(lambda: encoder.encode([0x50], header, payload), count),
+        'decode us/frame': decode / len(frames),
+    }
+
+def bench_codec(count=100000):
+    """field access cost of received packets and send_data results, command answer decoding
+
+Each against the original eager decoding, the baseline results."""
+    rx = memoryview(bytes([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, 0x01, 0xFF, 0xFF] + list(range(20))))
+    tx = memoryview(bytes([0x00, 0x01, 0xFF, 0xC0, 0x00, 0x00, 0x00, 0x0E, 0x00, 0x00, 0x00, 0x00]))
+    channel, info = EBI.COMMANDS[0x11], EBI.COMMANDS[0x01]
+    settings = { 'channel': 1, 'spreading_factor': 7, 'bandwidth': 0, 'coding_rate': 1 }
+    def receive():
+        packet = RxPacket(rx)
+        return packet.src, packet.rssi, packet.data
+    def result():
+        answer = TxResult(tx)
+        return answer.ok, answer.retries, answer.rssi
+    baseline = Baseline()
+    def baseline_result():
+        answer = baseline.send_data(tx)
+        return answer['status'] == 'Success', answer['retries'], answer['RSSI']
+    # answers are views over the receive buffer, as _send returns them
+    answer = memoryview(b'\x81\x01\x52\x00\x01\x02\x03\x04\x05\x06\x07')[1:]
+    return {
+        'RxPacket us/packet': per_call(receive, count),
+        'RxPacket baseline us/packet': per_call(lambda: baseline.receive(rx), count),
+        'RxPacket dict us/packet': per_call(lambda: dict(RxPacket(rx)), count),
+        'TxResult us/result': per_call(result, count),
+        'TxResult baseline us/result': per_call(baseline_result, count),
+        'TxResult dict us/result': per_call(lambda: dict(TxResult(tx)), count),
+        'channel decode us/answer': per_call(lambda: channel.decode(answer[:4]), count),
+        'info decode us/answer': per_call(lambda: info.decode(answer), count),
+        'info decode baseline us/answer': per_call(lambda: baseline.device_info(answer), count),
+        'channel encode us/request': per_call(lambda: channel.request.encode(settings), count),
+    }
+
+def bench_commands(rounds=200):
+    "round trip of device_state and sustained send_data rate, module answering at once"
+    module = ScriptedModule(latency=0)
+    ebi = EBI(module.port, lazy=True)
+    payload = bytes(range(20))
+    results = {
+        'device_state us': per_call(ebi.device_state, rounds),
+        'send_data us': per_call(lambda: ebi.send_data(payload), rounds),
+    }
+    results['send_data /s'] = 1e6 / results['send_data us']
+    ebi.close()
+    module.close()
+    return results
+
+def bench_rx(count=20000, burst=100):
+    "RX notifications per second through the reader thread into receive()"
+    module = ScriptedModule(latency=0)
+    ebi = EBI(module.port, lazy=True, queue_size=count, overflow='block')
+    encoder = FrameEncoder()
+    frame = bytes(encoder.encode([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, 0x01, 0xFF, 0xFF],
+                                 bytes(range(20))))
+    def push():
+        for _ in range(count // burst):
+            module.inject(frame * burst)
+    writer = threading.Thread(target=push, daemon=True)
+    start = time.perf_counter()
+    writer.start()
+    received = 0
+    while received < count // burst * burst:
+        packet = ebi.receive(timeout=5)
+        if packet is None:
+            break
+        received += 1
+    elapsed = time.perf_counter() - start
+    ebi.close()
+    module.close()
+    return { 'frames /s': received / elapsed }
+
+def bench_aggregation(size=12):
+    "messages carried per second of airtime, one per frame against aggregated"
+    results = {}
+    for sf in (7, 10):
+        single = lora.time_on_air(size + lora.OVERHEAD[0], sf)
+        per_frame = (lora.max_payload(sf) - 1) // (size + 1)
+        packed = lora.time_on_air(len(pack([bytes(size)] * per_frame)) + lora.OVERHEAD[0], sf)
+        results[f"SF{sf} single msg/airtime s"] = 1 / single
+        results[f"SF{sf} aggregated msg/airtime s"] = per_frame / packed
+    return results
+
+def sample_payloads(count=400):
+    "telemetry-like payloads: sender.py's pattern and short UTF-8 readings"
+    payloads = []
+    for index in range(count):
+        if index % 2:
+            payloads.append(bytes([0x12, 0x12, 0x12] + list(range(1, 21))))
+        else:
+            payloads.append(
+                f'{{"node":{index % 7},"temp":{20 + index % 9}.{index % 10},'
+                f'"hum":{40 + index % 13},"bat":3.{index % 10}}}'.encode()
+            )
+    return payloads
+
+def bench_compression(count=400):
+    "compression ratio, CPU cost and time on air saved, dictionary trained on half the samples"
+    payloads = sample_payloads(count)
+    codec = Codec(train(payloads[:count // 2]))
+    tests = payloads[count // 2:]
+    encoded = [codec.encode(payload) for payload in tests]
+    results = {
+        'ratio %': sum(map(len, encoded)) / sum(map(len, tests)) * 100,
+        'encode us/payload': per_call(lambda: [codec.encode(p) for p in tests], 10) / len(tests),
+        'decode us/payload': per_call(lambda: [codec.decode(p) for p in encoded], 10) / len(tests),
+    }
+    for sf in (7, 9, 12):
+        before = sum(lora.time_on_air(len(p) + lora.OVERHEAD[0], sf) for p in tests)
+        after = sum(lora.time_on_air(len(p) + lora.OVERHEAD[0], sf) for p in encoded)
+        results[f"SF{sf} airtime saved %"] = (before - after) / before * 100
+    return results
+
+def bench_dedup(count=200000, distinct=50000):
+    "DuplicateFilter cost per packet and memory once full, one packet in four a repeat"
+    frames = [
+        bytes([0xE0, 0x00, 0x00, 0xFF, 0xC0, index >> 8 & 0xFF, index & 0xFF, 0xFF, 0xFF])
+        + index.to_bytes(4, 'big') for index in range(distinct)
+    ]
+    stream = [frames[(index // 4 * 3 + min(index % 4, 2)) % distinct] for index in range(count)]
+    def run():
+        dedup = DuplicateFilter(window=3600, size=4096)
+        for now, frame in enumerate(stream):
+            dedup.check(frame, now * 1e-3)
+        return dedup
+    start = time.perf_counter()
+    dedup = run()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    kept = run()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return {
+        'check us/packet': elapsed / count * 1e6,
+        'suppressed %': dedup.duplicates / count * 100,
+        'kB held': size / 1024,
+    }
+
+def bench_store(count=500000, sources=64):
+    "packet store ingest cost, and queries of one source and of a time range"
+    packets = [
+        RxPacket(bytes([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, src, 0xFF, 0xFF]) + bytes(20))
+        for src in range(sources)
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = PacketStore(tmp, segment_bytes=8 << 20)
+        start = time.perf_counter()
+        for index in range(count):
+            store.append(packets[index % sources], 1e9 + index * 0.01)
+        results['ingest us/packet'] = (time.perf_counter() - start) / count * 1e6
+        end = 1e9 + count * 0.01
+        for name, query in (
+            ('source, last hour', { 'src': 5, 'start': end - 3600 }),
+            ('all, 10 s', { 'start': end - 3600, 'end': end - 3590 }),
+        ):
+            start = time.perf_counter()
+            found = store.query(**query)
+            results[f"{name} ms"] = (time.perf_counter() - start) * 1000
+            results[f"{name} packets"] = len(found)
+        store.close()
+    return results
+
+def bench_ring(count=200000):
+    "shared memory RX ring: publish cost and frames per second read in place"
+    frame = bytes([0xE0, 0x00, 0x00, 0xFF, 0xC0, 0x00, 0x01, 0xFF, 0xFF]) + bytes(20)
+    with tempfile.TemporaryDirectory() as tmp:
+        ring = RxRing.create(os.path.join(tmp, 'ring'), slots=count)
+        reader = RingReader(ring.path)
+        results = { 'publish us/frame': per_call(lambda: ring.publish(frame), count // 3) }
+        reader.next = 1
+        start = time.perf_counter()
+        for _ in range(count // 3):
+            _, view = reader.get(0)
+            view.release()
+        results['read frames/s'] = count // 3 / (time.perf_counter() - start)
+        reader.close()
+        ring.close()
+    return results
+
+SUITE = {
+    'framing': bench_framing,
+    'codec': bench_codec,
+    'packets': bench_packets,
+    'metrics': bench_metrics,
+    'startup': bench_startup,
+    'commands': bench_commands,
+    'rx': bench_rx,
+    'aggregation': bench_aggregation,
+    'compression': bench_compression,
+    'dedup': bench_dedup,
+    'store': bench_store,
+    'ring': bench_ring,
+}
+
+def run(names=None):
+    "run the named benchmarks (all by default), returning {benchmark: {result: value}}"
+    return { name: SUITE[name]() for name in names or SUITE }
+
+def higher_is_better(result):
+    "rates go up when things improve, durations and sizes go down"
+    return result.endswith('/s') or result.endswith('/airtime s') or result.endswith('saved %')
+
+def compare(results, baseline, tolerance=0.1):
+    """regressions of results against baseline beyond tolerance, as a relative change
+
+Returns a list of (benchmark, result, baseline value, value, change)."""
+    regressions = []
+    for name, values in results.items():
+        for result, value in values.items():
+            before = baseline.get(name, {}).get(result)
+            if not before:
+                continue
+            change = (value - before) / before
+            if (-change if higher_is_better(result) else change) > tolerance:
+                regressions.append((name, result, before, value, change))
+    return regressions
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    PARSER.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f"benchmarks to run, all by default: {', '.join(SUITE)}")
+    PARSER.add_argument('--json', metavar='FILE', help="save results as JSON")
+    PARSER.add_argument('--compare', metavar='BASELINE', help="JSON results to compare against")
+    PARSER.add_argument('--tolerance', type=float, default=0.1,
+                        help="relative slowdown accepted by --compare (default 0.1)")
+    ARGS = PARSER.parse_args()
+    for NAME in ARGS.benchmarks:
+        if NAME not in SUITE:
+            PARSER.error(f"unknown benchmark {NAME}")
+    RESULTS = run(ARGS.benchmarks)
+    for NAME, VALUES in RESULTS.items():
+        for RESULT, VALUE in VALUES.items():
+            print(f"{NAME:11s} {RESULT:30s} {VALUE:12.3f}")
+    if ARGS.json:
+        with open(ARGS.json, 'w', encoding='utf8') as output:
+            json.dump(RESULTS, output, indent=2, sort_keys=True)
+    if ARGS.compare:
+        with open(ARGS.compare, encoding='utf8') as saved:
+            REGRESSIONS = compare(RESULTS, json.load(saved), ARGS.tolerance)
+        for NAME, RESULT, BEFORE, VALUE, CHANGE in REGRESSIONS:
+            print(f"REGRESSION {NAME} {RESULT}: {BEFORE:.3f} -> {VALUE:.3f} ({CHANGE:+.0%})")
+        sys.exit(1 if REGRESSIONS else 0)
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+"""
+Bulk transfer between two modules over LoRaEMB unicast.
+
+A blob is cut into fragments that fill the payload of the current
+spreading factor. The sender sends a window of fragments back to back,
+the last one asking for an acknowledgement; the receiver answers with
+the index of the first fragment it misses and a bitmap of the ones it
+holds after it, and only the missing fragments go out again. The blob
+travels with its CRC32 appended, checked before the last acknowledgement;
+a blob failing it is dropped and sent again whole. Transfers are told
+apart by a random id and their fragment count: a sender given the id of
+an interrupted transfer resumes it from what the receiver kept.
+
+    e.send_blob([0x00, 0x02], data)            # on one module
+    src, data = e.receive_blob(timeout=60)     # on the other
+
+A sender that gives up raises an EBIError carrying the transfer id in
+ident, to resume with send_blob(dst, data, ident=exc.ident). The final
+acknowledgement is only sent again while the receiver is receiving: if
+it is lost, the sender raises Timeout although the blob arrived, unless
+the receiver lingers for a while after it.
+
+Packets (first byte):
+
+    DATA     type id(2) index(2) total(2) fragment   (type | ACK_REQUEST)
+    ACK      type id(2) base(2) count bitmap(BITMAP)
+    QUERY    type id(2) total(2) count
+
+count numbers the queries of a sender and the acknowledgements of a
+receiver, so that a retry is never byte-identical to the packet it
+repeats and EBI(dedup=...) lets it through.
+"""
+
+import collections
+import random
+import struct
+import sys
+import time
+import zlib
+from ebi import EBI, EBIError, Timeout, hexstr
+import lora
+
+DATA = 0xB0
+ACK_REQUEST = 0x08
+ACK = 0xB1
+QUERY = 0xB2
+HEADER = struct.Struct('>BHHH')
+ACK_HEADER = struct.Struct('>BHHB')
+QUERY_HEADER = struct.Struct('>BHHB')
+BITMAP = 8
+MAX_WINDOW = BITMAP * 8
+
+CRC = struct.Struct('>I')
+
+def transfer_id():
+    "random 16 bit identifier of a new transfer"
+    return random.getrandbits(16)
+
+def with_crc(data):
+    "data followed by its CRC32, as it is fragmented"
+    return data + CRC.pack(zlib.crc32(data))
+
+def check_crc(wire):
+    "data out of a reassembled blob, None if its CRC32 does not match"
+    if len(wire) < CRC.size or CRC.unpack_from(wire, len(wire) - CRC.size)[0] != \
+        zlib.crc32(wire[:-CRC.size]):
+        return None
+    return wire[:-CRC.size]
+
+def fragment_size(ebi):
+    "data bytes carried by one fragment with the module's current spreading factor"
+    sf = ebi.operating_channel().get('spreading_factor', 7)
+    return lora.max_payload(sf) - HEADER.size - (1 if ebi.codec else 0)
+
+class BlobSender:
+    """Sends one blob with a selective-repeat sliding window
+
+window fragments are sent per round; ack_timeout defaults to the time
+on air of a full round trip plus one second. A round with no answer is
+retried, by a QUERY, up to retries times before Timeout is raised.
+send transmits a payload (ebi.send_data by default, TxScheduler.send to
+respect the duty cycle); other is called with packets that are not an
+acknowledgement of this transfer. ident resumes the transfer of the
+same data that had that id, a new one is drawn otherwise; the errors
+run raises carry it in their ident attribute."""
+    def __init__(self, ebi, dst, data, window=16, ack_timeout=None, retries=5,
+                 send=None, other=None, ident=None):
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError(f"window must be 1 to {MAX_WINDOW}")
+        self.ebi = ebi
+        self.dst = list(dst)
+        self.data = with_crc(bytes(data))
+        self.window = window
+        self.retries = retries
+        self.send = send or ebi.send_data
+        self.other = other
+        self.id = transfer_id() if ident is None else ident
+        self.size = fragment_size(ebi)
+        self.total = max(1, -(-len(self.data) // self.size))
+        if self.total > 0xFFFF:
+            raise ValueError(f"blob of {len(data)} bytes needs more than 65535 fragments")
+        channel = ebi.operating_channel()
+        self.ack_timeout = ack_timeout or 1.0 + 2 * lora.time_on_air(
+            lora.max_payload(channel.get('spreading_factor', 7)) + lora.OVERHEAD[0],
+            channel.get('spreading_factor', 7), channel.get('bandwidth', 0),
+            channel.get('coding_rate', 1)
+        )
+        self.received = set()
+        self.fragments_sent = 0
+        self.rounds = 0
+        self.queries = 0
+    def fragment(self, index):
+        "DATA payload of fragment index, without the acknowledgement request"
+        chunk = self.data[index * self.size:(index + 1) * self.size]
+        return HEADER.pack(DATA, self.id, index, self.total) + chunk
+    def _transmit(self, payload):
+        result = self.send(payload, dst=self.dst)
+        if not result.ok:
+            raise EBIError(f"send_data failed: {result.status}")
+    def _missing(self):
+        return [index for index in range(self.total) if index not in self.received]
+    def _wait_ack(self):
+        deadline = time.monotonic() + self.ack_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            packet = self.ebi.receive(timeout=remaining) if remaining > 0 else None
+            if packet is None:
+                return False
+            data = packet.data
+            if len(data) >= ACK_HEADER.size and data[0] == ACK:
+                _, ident, base, _ = ACK_HEADER.unpack_from(data)
+                if ident == self.id and packet.src == int.from_bytes(bytes(self.dst), 'big'):
+                    # the receiver's word replaces ours: it may have dropped a corrupted blob
+                    self.received = set(range(min(base, self.total)))
+                    bitmap = data[ACK_HEADER.size:]
+                    for bit in range(len(bitmap) * 8):
+                        if bitmap[bit >> 3] & (0x80 >> (bit & 7)):
+                            self.received.add(base + bit)
+                    return True
+            if self.other:
+                self.other(packet)
+    def _query(self):
+        self.queries = (self.queries + 1) & 0xFF
+        self._transmit(QUERY_HEADER.pack(QUERY, self.id, self.total, self.queries))
+    def run(self):
+        "send the blob; returns the number of rounds it took"
+        try:
+            return self._run()
+        except EBIError as exc:
+            exc.ident = self.id
+            raise
+    def _run(self):
+        self._query()
+        failures = 0 if self._wait_ack() else 1
+        while True:
+            missing = self._missing()
+            if not missing:
+                return self.rounds
+            burst = missing[:self.window]
+            self.rounds += 1
+            for position, index in enumerate(burst):
+                payload = bytearray(self.fragment(index))
+                if position == len(burst) - 1:
+                    payload[0] |= ACK_REQUEST
+                self._transmit(payload)
+                self.fragments_sent += 1
+            while not self._wait_ack():
+                failures += 1
+                if failures > self.retries:
+                    raise Timeout(f"no acknowledgement from {hexstr(self.dst)}")
+                self._query()
+
+class BlobReceiver:
+    """Reassembles blobs, keeping partial ones so their senders can resume
+
+Up to keep partial transfers are held; finished ones are remembered so
+late queries still get a final acknowledgement, while receive or linger
+runs. other is called with packets that are not part of a transfer."""
+    def __init__(self, ebi, keep=8, other=None):
+        self.ebi = ebi
+        self.keep = keep
+        self.other = other
+        self.partial = collections.OrderedDict()
+        self.done = collections.OrderedDict()
+        self.ready = collections.deque()
+        self.acks = 0
+    def _ack(self, src, ident, total, fragments):
+        base = 0
+        while base < total and base in fragments:
+            base += 1
+        bitmap = bytearray(BITMAP)
+        for bit in range(BITMAP * 8):
+            if base + bit in fragments:
+                bitmap[bit >> 3] |= 0x80 >> (bit & 7)
+        self.acks = (self.acks + 1) & 0xFF
+        self.ebi.send_data(ACK_HEADER.pack(ACK, ident, base, self.acks) + bytes(bitmap),
+                           dst=[src >> 8, src & 0xFF])
+    def receive(self, timeout=None):
+        "wait for the next complete blob; returns (src, data), None on timeout"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            packet = self.ebi.receive(timeout=remaining)
+            if packet is None:
+                return None
+            blob = self._handle(packet)
+            if blob is not None:
+                self.ready.append(blob)
+        return self.ready.popleft()
+    def linger(self, duration):
+        """keep answering for duration seconds, typically once the last blob is in
+
+A sender whose final acknowledgement was lost asks for it again; blobs
+completed meanwhile are kept for receive."""
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            packet = self.ebi.receive(timeout=remaining)
+            if packet is not None:
+                blob = self._handle(packet)
+                if blob is not None:
+                    self.ready.append(blob)
+    def _handle(self, packet):
+        data = packet.data
+        kind = data[0] if data else None
+        if kind == QUERY and len(data) >= QUERY_HEADER.size:
+            _, ident, total, _ = QUERY_HEADER.unpack_from(data)
+            key = (packet.src, ident, total)
+            if key in self.done:
+                self._ack(packet.src, ident, total, range(total))
+            else:
+                self._ack(packet.src, ident, total, self.partial.get(key, {}))
+            return None
+        if kind not in (DATA, DATA | ACK_REQUEST) or len(data) < HEADER.size:
+            if self.other:
+                self.other(packet)
+            return None
+        _, ident, index, total = HEADER.unpack_from(data)
+        if index >= total:
+            return None
+        key = (packet.src, ident, total)
+        if key in self.done:
+            if kind & ACK_REQUEST:
+                self._ack(packet.src, ident, total, range(total))
+            return None
+        if key not in self.partial:
+            self.partial[key] = {}
+            while len(self.partial) > self.keep:
+                self.partial.popitem(last=False)
+        fragments = self.partial[key]
+        fragments[index] = bytes(data[HEADER.size:])
+        if len(fragments) < total:
+            if kind & ACK_REQUEST:
+                self._ack(packet.src, ident, total, fragments)
+            return None
+        blob = check_crc(b''.join(fragments[index] for index in range(total)))
+        if blob is None:
+            # corrupted: start over, the acknowledgement asks for every fragment again
+            fragments.clear()
+            self._ack(packet.src, ident, total, fragments)
+            return None
+        del self.partial[key]
+        self.done[key] = True
+        while len(self.done) > self.keep:
+            self.done.popitem(last=False)
+        self._ack(packet.src, ident, total, range(total))
+        return packet.src, blob
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"Usage: {sys.argv[0]} device send file dst | {sys.argv[0]} device receive file")
+        sys.exit(1)
+    e = EBI(sys.argv[1], lazy=True)
+    print("CONFIG:", e.apply_config(channel=(1,7,0,1), start=True))
+    if sys.argv[2] == 'send':
+        with open(sys.argv[3], 'rb') as blob_file:
+            BLOB = blob_file.read()
+        DST = int(sys.argv[4], 0)
+        START = time.monotonic()
+        ROUNDS = e.send_blob([DST >> 8, DST & 0xFF], BLOB)
+        print(f"sent {len(BLOB)} bytes in {ROUNDS} rounds, {time.monotonic() - START:.1f} s")
+    else:
+        SRC, BLOB = e.receive_blob()
+        with open(sys.argv[3], 'wb') as blob_file:
+            blob_file.write(BLOB)
+        print(f"received {len(BLOB)} bytes from {SRC:04x}")
+        # in case the sender missed the last acknowledgement
+        e.receive_blob(timeout=0, linger=15)
+    e.close()
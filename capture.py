@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+"""
+Binary capture of EBI frames.
+
+A capture file starts with MAGIC and holds one record per frame: a
+RECORD header (timestamp, direction, port id, length) followed by the
+raw frame. A port id is declared by a PORT record carrying the port
+name before its first frame; each rotated file declares its own.
+"""
+
+import os
+import struct
+import sys
+import threading
+import time
+from ebi import EBI, RxPacket, TxResult, hexstr
+
+MAGIC = b'EBICAP1\n'
+RECORD = struct.Struct('<dcBH')
+PORT = b'P'
+
+class CaptureWriter:
+    """Frame tap writing a buffered, rotating binary capture"""
+    def __init__(self, path, max_bytes=16 << 20, backups=4, buffering=1 << 16):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffering = buffering
+        self._lock = threading.Lock()
+        self._file = None
+        self._ports = {}
+        self._open()
+    def _open(self):
+        self._file = open(self.path, 'ab', buffering=self.buffering)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._ports = {}
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+    def __call__(self, direction, port, frame):
+        now = time.time()
+        with self._lock:
+            if self._file is None:
+                return
+            port_id = self._ports.get(port)
+            if port_id is None:
+                port_id = self._ports[port] = len(self._ports) & 0xFF
+                name = port.encode('utf8')
+                self._file.write(RECORD.pack(now, PORT, port_id, len(name)))
+                self._file.write(name)
+            self._file.write(RECORD.pack(now, direction.encode(), port_id, len(frame)))
+            self._file.write(frame)
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+    def flush(self):
+        "push buffered records to disk"
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+    def close(self):
+        "flush and close the capture"
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_capture(path):
+    "iterate over (timestamp, direction, port, frame) records of a capture file"
+    with open(path, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an EBI capture")
+        ports = {}
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, port_id, length = RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                return
+            if direction == PORT:
+                ports[port_id] = data.decode('utf8')
+                continue
+            yield timestamp, direction.decode(), ports.get(port_id, str(port_id)), data
+
+def describe(frame, request=None):
+    """human readable meaning of a raw frame, using the EBI tables
+
+request is the command frame a response answers, if known: it tells
+a setter status from a getter value."""
+    body = frame[2:-1]
+    code = body[0]
+    name = EBI.COMMAND.get(code if code == 0xE0 else code & 0x7F, f"{code:#04x}")
+    if code == 0xE0:
+        return f"{name} {RxPacket(body)}"
+    if code == 0xD0:
+        return f"{name} {TxResult(body[1:])}"
+    if code == 0x84:
+        return f"{name} {EBI.DEVICE_STATE.get(body[1], body[1]) if len(body) > 1 else ''}"
+    if code == 0x81 and len(body) > 2:
+        protocol = EBI.PROTOCOL.get(body[1], body[1])
+        module = EBI.EMBIT_MODULE.get(body[2], body[2])
+        return f"{name} {protocol} {module} uuid {hexstr(body[3:])}"
+    if code & 0x80 and len(body) == 2:
+        params = 2 if code == 0xFE else 1
+        if request is None or len(request) - 3 > params or code in (0x85, 0xB0, 0xB1):
+            return f"{name} {EBI.STATUS.get(body[1], hexstr(body[1:]))}"
+    return f"{name} {hexstr(body[1:])}"
+
+def decode(path):
+    "pretty-print a capture file"
+    requests = {}
+    for timestamp, direction, port, frame in read_capture(path):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        if direction == '>':
+            requests[port] = frame
+            arrow, meaning = 'cmd ->', describe(frame)
+        else:
+            arrow, meaning = 'ans <-', describe(frame, requests.get(port))
+        print(f"{when}.{int(timestamp * 1000) % 1000:03d} {port} {arrow} {hexstr(frame)}")
+        print(f"    {meaning}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} capture_file [...]")
+        sys.exit(1)
+    for PATH in sys.argv[1:]:
+        decode(PATH)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+"""
+Payload compression with a shared, pre-trained deflate dictionary.
+
+An encoded payload starts with a header byte: RAW when compression did
+not make it smaller, DEFLATE when the rest is a raw deflate stream
+primed with the dictionary. Both ends must use the same dictionary.
+
+    codec = Codec(open('payloads.dict', 'rb').read())
+    e = EBI(dev, codec=codec)      # send_data and receive go through it
+
+Train a dictionary from captures made with capture.py:
+
+    compress.py payloads.dict capture_file [...]
+"""
+
+import collections
+import sys
+import zlib
+from capture import read_capture
+
+RAW = 0xC0
+DEFLATE = 0xC1
+
+class Codec:
+    """Deflate codec primed with a shared dictionary
+
+Payloads not starting with a codec header are handed back unchanged by
+decode, so peers without the codec still get through; a raw payload of
+theirs starting with RAW loses that byte, one starting with DEFLATE is
+handed back unchanged unless it happens to be a complete deflate stream."""
+    def __init__(self, dictionary=b'', level=9):
+        self.dictionary = bytes(dictionary)
+        self.level = level
+    def _compressor(self):
+        if self.dictionary:
+            return zlib.compressobj(self.level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY,
+                                    self.dictionary)
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15, 9)
+    def encode(self, payload):
+        "header and payload, compressed if that makes it shorter"
+        payload = bytes(payload)
+        compressor = self._compressor()
+        packed = compressor.compress(payload) + compressor.flush()
+        if len(packed) < len(payload):
+            return bytes([DEFLATE]) + packed
+        return bytes([RAW]) + payload
+    def decode(self, data):
+        "original payload out of an encoded one, data itself if it is not one"
+        if not data or data[0] not in (RAW, DEFLATE):
+            return bytes(data)
+        if data[0] == RAW:
+            return bytes(data[1:])
+        if self.dictionary:
+            decompressor = zlib.decompressobj(-15, self.dictionary)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        try:
+            payload = decompressor.decompress(data[1:])
+        except zlib.error: # not ours after all
+            return bytes(data)
+        if not decompressor.eof or decompressor.unused_data:
+            return bytes(data)
+        return payload
+
+def train(payloads, size=1024, min_length=3, max_length=32):
+    """build a dictionary out of sample payloads
+
+Substrings found in several payloads are scored by how many bytes they
+would save and the best ones kept, the most valuable last, where
+deflate reaches them with the shortest distances."""
+    counts = collections.Counter()
+    for payload in payloads:
+        payload = bytes(payload)
+        counts.update({
+            payload[start:start + length]
+            for length in range(min_length, max_length + 1)
+            for start in range(len(payload) - length + 1)
+        })
+    candidates = sorted(
+        ((count * (len(text) - 2), text) for text, count in counts.items() if count > 1),
+        reverse=True
+    )
+    chosen, total = [], 0
+    for _, text in candidates:
+        if total >= size:
+            break
+        if any(text in kept for kept in chosen):
+            continue
+        chosen = [kept for kept in chosen if kept not in text]
+        chosen.append(text)
+        total = sum(len(kept) for kept in chosen)
+    return b''.join(reversed(chosen))[-size:]
+
+def captured_payloads(paths):
+    "payloads sent (0x50) and received (0xE0) in capture files, LoRaEMB framing assumed for RX"
+    for path in paths:
+        for _, direction, _, frame in read_capture(path):
+            body = frame[2:-1]
+            if direction == '>' and body[0] == 0x50 and len(body) > 3:
+                payload = body[4:] if body[1] == 0x09 else body[5:]
+            elif direction == '<' and body[0] == 0xE0:
+                payload = body[9:]
+            else:
+                continue
+            if payload[:1] == bytes([RAW]):
+                payload = payload[1:]
+            elif payload[:1] == bytes([DEFLATE]):
+                continue
+            if payload:
+                yield payload
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"Usage: {sys.argv[0]} dictionary_file capture_file [...]")
+        sys.exit(1)
+    PAYLOADS = list(captured_payloads(sys.argv[2:]))
+    DICTIONARY = train(PAYLOADS)
+    with open(sys.argv[1], 'wb') as output:
+        output.write(DICTIONARY)
+    CODEC = Codec(DICTIONARY)
+    BEFORE = sum(len(payload) for payload in PAYLOADS)
+    AFTER = sum(len(CODEC.encode(payload)) for payload in PAYLOADS)
+    print(f"{len(DICTIONARY)} byte dictionary from {len(PAYLOADS)} payloads: "
+          f"{BEFORE} -> {AFTER} bytes ({AFTER / max(BEFORE, 1):.0%})")
@@ -4,10 +4,356 @@ Python implementation for EBI protocol.
 """
 
 import sys
+import collections
+import collections.abc
+import heapq
+import itertools
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import weakref
+from concurrent.futures import Future
 import serial
 
+class EBIError(Exception):
+    """base class for EBI errors"""
+
+class ChecksumError(EBIError):
+    """a frame failed the BCC check"""
+
+class UnexpectedResponse(EBIError):
+    """the module answered with something other than what was asked"""
+
+class Timeout(EBIError, TimeoutError):
+    """the module did not answer in time"""
+
+def hexstr(arr):
+    "format arr as hexstring"
+    try:
+        return arr.hex(":") # no copy of a memoryview
+    except AttributeError: # a list
+        return hexstr(bytes(arr))
+    except TypeError: # no separator on older Python3
+        return arr.hex()
+
+def print_frame(direction, port, frame):
+    "frame tap printing every frame, the classic debug output"
+    # pylint: disable=unused-argument
+    print('cmd ->' if direction == '>' else 'ans <-', hexstr(frame))
+
+def tee(*taps):
+    "frame tap feeding every given tap"
+    taps = [tap for tap in taps if tap]
+    def _tee(direction, port, frame):
+        for tap in taps:
+            tap(direction, port, frame)
+    return _tee
+
+class FrameDecoder:
+    """Incremental EBI frame decoder working on a single receive buffer
+
+Junk on the line (a corrupted byte, the tail of a frame cut by a
+timeout) is skipped one byte at a time until a plausible length prefix
+followed by a matching BCC is found again; skipped bytes are counted in
+discarded, checksum failures seen while in sync in corrupt."""
+    def __init__(self, max_length=0x200, on_corrupt=None):
+        self.buffer = bytearray()
+        self.max_length = max_length
+        self.on_corrupt = on_corrupt
+        self.corrupt = 0
+        self.discarded = 0
+        self._synced = True
+    def feed(self, data):
+        """append data and return the complete frames it terminates
+
+Frames are memoryviews over the receive buffer, length prefix and BCC
+included; the buffer is never resized while frames point into it, a
+fresh one takes over the trailing partial frame instead."""
+        self.buffer += data
+        return self._parse(idle=False)
+    def resync(self):
+        "the line went quiet: a partial frame left in the buffer is junk"
+        return self._parse(idle=True)
+    def _parse(self, idle):
+        buf = self.buffer
+        view = memoryview(buf)
+        frames = []
+        offset, end = 0, len(buf)
+        while offset < end:
+            if end - offset < 2:
+                if not idle:
+                    break
+            else:
+                length = (buf[offset] << 8) + buf[offset + 1]
+                if 3 <= length <= self.max_length:
+                    if end - offset >= length:
+                        frame = view[offset:offset + length]
+                        if frame[-1] == sum(frame[:-1]) & 0xFF:
+                            frames.append(frame)
+                            offset += length
+                            self._synced = True
+                            continue
+                        if self._synced:
+                            self.corrupt += 1
+                            if self.on_corrupt:
+                                self.on_corrupt(frame)
+                    elif not idle:
+                        break
+            # not the start of a valid frame: drop a byte and hunt on
+            self._synced = False
+            self.discarded += 1
+            offset += 1
+        if offset:
+            self.buffer = buf[offset:]
+        return frames
+
+class RingBuffer:
+    """Bounded FIFO filled by the reader thread
+
+When full, policy decides what happens to an incoming item: 'drop_oldest'
+makes room for it, 'drop_newest' discards it and 'block' waits for a
+consumer, stalling the reader thread (command responses included)."""
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+    def __init__(self, size=256, policy='drop_oldest'):
+        if policy not in RingBuffer.POLICIES:
+            raise ValueError(f"unknown overflow policy {policy}")
+        self.size = size
+        self.policy = policy
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+    def __len__(self):
+        return len(self._items)
+    def close(self):
+        "wake up and release everybody waiting on the buffer"
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+    def put(self, item):
+        "store item, applying the overflow policy; False if it was dropped"
+        with self._cond:
+            self.received += 1
+            if len(self._items) >= self.size:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                if self.policy == 'drop_oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self._cond.wait_for(lambda: len(self._items) < self.size or self.closed)
+                    if self.closed:
+                        return False
+            self._items.append(item)
+            self._cond.notify_all()
+            return True
+    def take(self, count, timeout=None):
+        "get up to count items, waiting at most timeout for that many to arrive"
+        with self._cond:
+            count = min(count, self.size)
+            self._cond.wait_for(lambda: len(self._items) >= count or self.closed, timeout)
+            items = [self._items.popleft() for _ in range(min(count, len(self._items)))]
+            if items:
+                self._cond.notify_all()
+            return items
+    def get(self, timeout=None):
+        "get the oldest item, None on timeout"
+        items = self.take(1, timeout)
+        return items[0] if items else None
+
+class DuplicateFilter:
+    """Time-windowed memory of received packets
+
+A 0xE0 frame is a duplicate of one seen less than window seconds
+earlier from the same source, to the same destination, with the same
+payload; RSSI and options do not count. At most size packets are
+remembered, the oldest forgotten first, each as a hash of those bytes."""
+    def __init__(self, window=10.0, size=4096):
+        self.window = window
+        self.size = size
+        self.checked = 0
+        self.duplicates = 0
+        self._seen = {}
+        self._order = collections.deque()
+    def __len__(self):
+        return len(self._seen)
+    def check(self, frame, now=None):
+        "True if frame duplicates a recent one, remembering it otherwise"
+        now = time.monotonic() if now is None else now
+        seen, order = self._seen, self._order
+        while order and (order[0][0] <= now - self.window or len(order) >= self.size):
+            stamp, old = order.popleft()
+            if seen.get(old) == stamp:
+                del seen[old]
+        self.checked += 1
+        key = hash(bytes(frame[5:]))
+        if key in seen:
+            self.duplicates += 1
+            return True
+        seen[key] = now
+        order.append((now, key))
+        return False
+
+class Layout:
+    """Binary layout of a command or response body, compiled to a struct.Struct
+
+spec lists the fields in order as name:code, code being a struct format
+code read big endian; a last *name field takes the variable length tail.
+Fields beyond the end of a short body are left out when decoding."""
+    __slots__ = ('names', 'struct', 'tail', 'fields')
+    def __init__(self, spec=''):
+        specs = spec.split()
+        self.tail = specs.pop()[1:] if specs and specs[-1][0] == '*' else None
+        self.names = tuple(field.split(':')[0] for field in specs)
+        codes = [field.split(':')[1] for field in specs]
+        self.struct = struct.Struct('>' + ''.join(codes))
+        self.fields = {}
+        offset = 0
+        for name, code in zip(self.names, codes):
+            single = struct.Struct('>' + code)
+            self.fields[name] = (single, offset, offset + single.size)
+            offset += single.size
+    def decode(self, body):
+        "{name: value} of the fields of body, tail included"
+        if len(body) >= self.struct.size:
+            values = dict(zip(self.names, self.struct.unpack_from(body)))
+        else:
+            values = {
+                name: single.unpack_from(body, start)[0]
+                for name, (single, start, end) in self.fields.items() if end <= len(body)
+            }
+        if self.tail is not None:
+            values[self.tail] = bytes(body[self.struct.size:])
+        return values
+    def values(self, body):
+        "field values of body in order, None past its end, then the tail if any"
+        values = [
+            single.unpack_from(body, start)[0] if end <= len(body) else None
+            for single, start, end in self.fields.values()
+        ]
+        if self.tail is not None:
+            values.append(bytes(body[self.struct.size:]))
+        return values
+    def unpacker(self, length):
+        "function unpacking a body of length into values(body), in one unpack_from if it can"
+        size = self.struct.size
+        if length < size:
+            return self.values
+        if self.tail is None:
+            return self.struct.unpack_from
+        return struct.Struct(f"{self.struct.format}{length - size}s").unpack_from
+    def encode(self, values):
+        "body out of {name: value}"
+        body = self.struct.pack(*(values[name] for name in self.names))
+        if self.tail is not None:
+            body += bytes(values[self.tail])
+        return body
+    def field(self, name, doc=None):
+        "read-only property decoding one field out of the frame of a Frame, None if too short"
+        single, start, _ = self.fields[name]
+        unpack = single.unpack_from
+        # plain indexing is faster for a byte or an unsigned short
+        if single.format == '>B':
+            def get(frame):
+                try:
+                    return frame.frame[start]
+                except IndexError:
+                    return None
+        elif single.format == '>H':
+            def get(frame):
+                data = frame.frame
+                try:
+                    return (data[start] << 8) + data[start + 1]
+                except IndexError:
+                    return None
+        else:
+            def get(frame):
+                try:
+                    return unpack(frame.frame, start)[0]
+                except struct.error:
+                    return None
+        return property(get, doc=doc)
+
+class Command:
+    """Declarative EBI command
+
+prefix is sent first (command code, and sub-command if any), followed
+by the request layout of a setter's parameters. A getter's answer is
+decoded with the response layout and its values passed to view in
+order, the tail last, for the method's result; fields past the end of a
+short answer are None. The struct of each answer length, the tail as a
+last bytes field, is compiled once, so decoding is one unpack_from.
+Without a view the result is the {name: value} dict of the fields,
+without a response layout view gets the raw body."""
+    __slots__ = ('name', 'prefix', 'request', 'response', 'view', 'decode')
+    def __init__(self, name, prefix, request='', response='', view=None):
+        self.name = name
+        self.prefix = bytes(prefix)
+        self.request = Layout(request)
+        self.response = Layout(response) if response else None
+        self.view = view
+        self.decode = self._compile()
+    def _compile(self):
+        "method result out of a response body"
+        layout, view = self.response, self.view
+        if layout is None:
+            return view
+        if view is None:
+            return layout.decode
+        if not layout.names: # the tail is the whole body
+            return view
+        unpackers = {}
+        def decode(body):
+            try:
+                fields = unpackers[len(body)](body)
+            except KeyError: # first answer of that length
+                unpack = unpackers[len(body)] = layout.unpacker(len(body))
+                fields = unpack(body)
+            return view(*fields)
+        return decode
+
+class Submission:
+    """send_data request waiting in the TX queue"""
+    __slots__ = ('key', 'future', 'payload', 'kwargs', 'expires')
+    def __init__(self, key, payload, kwargs, expires):
+        self.key = key
+        self.future = Future()
+        self.payload = payload
+        self.kwargs = kwargs
+        self.expires = expires
+
+class FrameEncoder:
+    """EBI frame encoder writing into a preallocated buffer"""
+    def __init__(self, size=0x10000):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+    def encode(self, *parts):
+        """build a frame out of parts and return a view of it
+
+The view is only valid until the next call to encode."""
+        buf = self.buffer
+        pos = 2
+        for part in parts:
+            end = pos + len(part)
+            buf[pos:end] = part
+            pos = end
+        size = pos + 1
+        buf[0] = size >> 8 & 0xFF
+        buf[1] = size & 0xFF
+        buf[pos] = sum(self.view[:pos]) & 0xFF
+        return self.view[:size]
+
 class EBI:
-    """EBI protocol class"""
+    """EBI protocol class
+
+close() it when done, or use it in a with statement. The reader and
+submit threads only hold weak references, so an EBI dropped without
+close() is still closed when it is collected."""
     STATUS = {
         0x00: 'Success',
         0x01: 'Generic error',
@@ -100,169 +446,851 @@ class EBI:
         0x01: 'RX WINDOW',
         0x02: 'TX ONLY',
     }
-    def __init__(self,dev, debug=True):
-        self.debug = debug
+    BOOT_STATES = (0x00, 0x01, 0x10, 0x11)
+    COMMAND = {
+        0x01: 'Device information',
+        0x04: 'Device state',
+        0x05: 'Reset',
+        0x06: 'Firmware version',
+        0x10: 'Output power',
+        0x11: 'Operating channel',
+        0x13: 'Energy save',
+        0x21: 'Network address',
+        0x22: 'Network identifier',
+        0x25: 'Network preference',
+        0x30: 'Network stop',
+        0x31: 'Network start',
+        0x50: 'Send data',
+        0x7E: 'Extended command',
+        0xE0: 'Received data',
+    }
+    IDENTITY = ('ebi_protocol', 'embit_module', 'uuid', 'firmware_version')
+    # request and response layouts by command code; setters answer with a status byte
+    COMMANDS = {
+        0x01: Command(
+            'device_info', [0x01], response='protocol:B module:B *uuid',
+            view=lambda protocol, module, uuid: {
+                'ebi_protocol': EBI.PROTOCOL.get(protocol, None),
+                'embit_module': EBI.EMBIT_MODULE.get(module, None),
+                'uuid': hexstr(uuid),
+            }
+        ),
+        0x04: Command('device_state', [0x04], response='state:B', view=lambda state: {
+            'state': EBI.DEVICE_STATE.get(state, None)
+        }),
+        0x05: Command('reset', [0x05], response='status:B', view=lambda status: {
+            'status': EBI.STATUS.get(status, status)
+        }),
+        0x06: Command('firmware_version', [0x06], response='*version', view=lambda version: {
+            'firmware_version': hexstr(version)
+        }),
+        0x10: Command('output_power', [0x10], 'power:B', 'power:B'),
+        0x11: Command(
+            'operating_channel', [0x11],
+            'channel:B spreading_factor:B bandwidth:B coding_rate:B',
+            'channel:B spreading_factor:B bandwidth:B coding_rate:B'
+        ),
+        0x13: Command('energy_save', [0x13], 'policy:B', 'policy:B', view=lambda policy: {
+            'policy': EBI.MODULE_SLEEP_POLICY.get(policy, policy)
+        }),
+        0x21: Command('network_address', [0x21], '*address', '*address', view=lambda address: {
+            'address': hexstr(address)
+        }),
+        0x22: Command(
+            'network_identifier', [0x22], '*identifier', '*identifier',
+            view=lambda identifier: { 'identifier': hexstr(identifier) }
+        ),
+        0x25: Command(
+            'network_preference', [0x25], 'preference:B', 'preference:B',
+            view=lambda preference: {
+                'protocol': 'LoRaWAN' if preference & 0x80 else 'LoRaEMB',
+                'auto_join': (preference & 0x40) != 0,
+                'adr': (preference & 0x20) != 0,
+            }
+        ),
+        0x30: Command('network_stop', [0x30], response='status:B', view=lambda status: {
+            'status': EBI.STATUS.get(status, status)
+        }),
+        0x31: Command('network_start', [0x31], response='status:B', view=lambda status: {
+            'status': EBI.STATUS.get(status, status)
+        }),
+        # LoRaEMB layout, see SEND_DATA_LORAWAN; the answer is kept whole as a TxResult
+        0x50: Command(
+            'send_data', [0x50], 'options:H dst:H *payload', view=lambda ans: TxResult(ans)
+        ),
+        0x7E: Command('ieee_address', [0x7E, 0x20], '*mac', '*mac', view=lambda mac: {
+            'ieee_address': hexstr(mac)
+        }),
+    }
+    SEND_DATA_LORAWAN = Layout('options:H port:B *payload')
+    def __init__(
+        self, dev, debug=False, timeout=5, queue_size=256, overflow='drop_oldest',
+        lazy=False, identity_cache=None, tap=None, codec=None, dedup=None
+    ):
+        self.tap = tap
+        self.tap_error = None
+        self.codec = codec
+        self.dedup = DuplicateFilter(dedup) if dedup else None
+        if debug:
+            self.debug = debug
         self.dev = dev
-        self.ser = serial.Serial(self.dev,baudrate=9600,timeout=5)
-        self.state = self.device_info()
-        self.state.update(self.device_state())
-        self.state.update(self.firmware_version())
+        self.timeout = timeout
+        self.identity_cache = identity_cache
+        self.ser = self._open()
+        self._decoder = FrameDecoder(on_corrupt=self._corrupt)
+        self._encoder = FrameEncoder()
+        self.malformed = 0
+        self.rx = RingBuffer(queue_size, overflow)
+        self.notifications = RingBuffer(queue_size)
+        self._lock = threading.RLock()
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+        self._cache = {}
+        # the reader thread invalidates the cache when the module reboots
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.state = {}
+        self._blobs = None
+        self.tx_coalesced = 0
+        self.tx_expired = 0
+        self._tx_queue = []
+        self._tx_pending = {}
+        self._tx_order = itertools.count()
+        self._tx_cond = threading.Condition()
+        self._tx_worker = None
+        self._tx_closed = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self._reader = threading.Thread(
+            target=EBI._read_loop, args=(weakref.ref(self), self.ser),
+            name=f"ebi-reader {dev}", daemon=True
+        )
+        self._reader.start()
+        if not lazy:
+            self.identity()
+            self.state.update(self.device_state())
     def __del__(self):
-        if getattr(self, 'ser', None):
-            self.ser.close()
-    def __bcc(self, packet):
-        return sum(packet) & 0xFF
+        self.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def _open(self):
+        "open the port; the reader thread only needs read, in_waiting, write and cancel_read"
+        return serial.Serial(self.dev,baudrate=9600,timeout=0.2)
+    def close(self):
+        "stop the reader thread and close the port"
+        running = getattr(self, '_running', None)
+        if running is None or not running.is_set():
+            return
+        running.clear()
+        with self._tx_cond:
+            self._tx_closed.set()
+            self._tx_cond.notify()
+        if self._tx_worker is not None and self._tx_worker is not threading.current_thread():
+            self._tx_worker.join()
+        for submission in self._tx_pending.values():
+            submission.future.cancel()
+        self.rx.close()
+        self.notifications.close()
+        if self._reader is not threading.current_thread():
+            self.ser.cancel_read()
+            self._reader.join()
+        self.ser.close()
+    @property
+    def debug(self):
+        "True while every frame is printed"
+        return self.tap is print_frame
+    @debug.setter
+    def debug(self, value):
+        if value:
+            self.tap = print_frame
+        elif self.tap is print_frame:
+            self.tap = None
+    @property
+    def dropped(self):
+        "frames lost to a full receive or notification buffer"
+        return self.rx.dropped + self.notifications.dropped
+    @property
+    def duplicates(self):
+        "received packets suppressed as duplicates"
+        return self.dedup.duplicates if self.dedup else 0
+    @property
+    def corrupt(self):
+        "frames that failed the BCC check"
+        return self._decoder.corrupt
+    @property
+    def discarded(self):
+        "bytes skipped while hunting for a frame boundary"
+        return self._decoder.discarded
     def hex(self, arr):
         "print arr as hexstring"
+        return hexstr(arr)
+    @staticmethod
+    def _read_loop(ref, ser):
+        "reader thread: route responses to waiting callers, queue notifications"
+        # the EBI is only referenced between reads, so that it can be collected
+        while True:
+            try:
+                # block for the first byte, then drain whatever arrived with it
+                data = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                ebi = ref()
+                if ebi is not None and ebi._running.is_set():
+                    raise
+                return
+            ebi = ref()
+            if ebi is None or not ebi._running.is_set():
+                return
+            ebi._received(data)
+            del ebi
+    def _received(self, data):
+        stamp = time.time()
+        frames = self._decoder.feed(data) if data else self._decoder.resync()
+        for frame in frames:
+            if self.tap:
+                self._tap('<', frame)
+            try:
+                self._dispatch(frame[2:-1], stamp)
+            except Exception: # pylint: disable=broad-except
+                # one bad frame must not end the reader thread
+                self.malformed += 1
+    def _tap(self, direction, frame):
+        "feed the tap; one that raises is removed and its error kept in tap_error"
         try:
-            _hex = bytes(arr).hex(":")
-        except TypeError: # no separator on older Python3
-            _hex = bytes(arr).hex()
-        return _hex
-    def _read(self):
-        ans = list(self.ser.read(2))
-        if len(ans) != 2:
-            return None
-        length = (ans[0] << 8) + ans[1]
-        ans += list(self.ser.read(length-2))
-        if self.debug:
-            print('ans <-', self.hex(ans))
-        assert ans[-1] == self.__bcc(ans[:-1])
-        return ans[2:-1]
-    def _send(self,command):
-        size = len(command) + 3
-        packet  = [size >> 8 & 0xFF, size & 0xFF]
-        packet += command
-        packet += [self.__bcc(packet)]
-        if self.debug:
-            print('cmd ->', self.hex(packet))
-        self.ser.write(bytes(packet))
-        ans = self._read()
-        assert ans[0] == (command[0] | 0x80)
+            self.tap(direction, self.dev, frame)
+        except Exception as exc: # pylint: disable=broad-except
+            self.tap = None
+            self.tap_error = exc
+    def _dispatch(self, frame, stamp=None):
+        if not frame or (frame[0] == 0x84 and len(frame) < 2):
+            # a valid BCC around a body too short to mean anything
+            self.malformed += 1
+            return
+        with self._waiters_lock:
+            waiter = self._waiters.pop(frame[0], None)
+        if waiter is not None:
+            waiter.put(frame)
+            return
+        if frame[0] == 0x84:
+            if frame[1] in EBI.BOOT_STATES:
+                # the module rebooted on its own, its configuration may be gone
+                self.invalidate()
+            self.state['state'] = EBI.DEVICE_STATE.get(frame[1], None)
+        if frame[0] == 0xE0:
+            if self.dedup is None or not self.dedup.check(frame):
+                self.rx.put((time.time() if stamp is None else stamp, frame))
+        else:
+            self.notifications.put(frame)
+    def _corrupt(self, frame):
+        "fail the caller waiting for a response that arrived corrupted"
+        with self._waiters_lock:
+            waiter = self._waiters.pop(frame[2], None)
+        if waiter is not None:
+            waiter.put(ChecksumError(f"bad BCC in frame {self.hex(frame)}"))
+    def _expect(self, code):
+        "register interest in the next frame with the given code"
+        waiter = queue.Queue(1)
+        with self._waiters_lock:
+            self._waiters[code] = waiter
+        return waiter
+    def _wait(self, code, waiter, timeout=None):
+        "wait for a frame registered with _expect"
+        try:
+            ans = waiter.get(timeout=self.timeout if timeout is None else timeout)
+        except queue.Empty:
+            raise Timeout(f"no frame {code:#04x} from {self.dev}") from None
+        finally:
+            with self._waiters_lock:
+                if self._waiters.get(code) is waiter:
+                    del self._waiters[code]
+        if isinstance(ans, EBIError):
+            raise ans
+        return ans
+    def _send(self, command, *parts, timeout=None):
+        code = command[0] | 0x80
+        with self._lock:
+            packet = self._encoder.encode(command, *parts)
+            if self.tap:
+                self._tap('>', packet)
+            waiter = self._expect(code)
+            self.ser.write(packet)
+            ans = self._wait(code, waiter, timeout)
+        if ans[0] != code:
+            raise UnexpectedResponse(f"expected {code:#04x}, got {self.hex(ans)}")
         return ans[1:]
+    def _cached(self, getter, refresh=False):
+        "answer a getter from the configuration cache"
+        with self._cache_lock:
+            values = None if refresh else self._cache.get(getter)
+            if values is not None:
+                self.cache_hits += 1
+                return dict(values)
+            self.cache_misses += 1
+            return None
+    def _store(self, getter, values):
+        "record a getter answer in the configuration cache"
+        with self._cache_lock:
+            self._cache[getter] = values
+            self.state.update(values)
+        return dict(values)
+    def _written(self, getter, ans, values):
+        "setter result; on success the new values go to the cache"
+        status = EBI.STATUS.get(ans[0],ans[0])
+        if status == 'Success':
+            self._store(getter, values)
+        return { 'status': status }
+    def invalidate(self):
+        "forget the cached module configuration"
+        with self._cache_lock:
+            for values in self._cache.values():
+                for key in values:
+                    self.state.pop(key, None)
+            self._cache.clear()
+    def identity(self, refresh=False):
+        """get device identity (protocol, module type, uuid, firmware version)
+
+Queried once and kept in self.state. With an identity_cache file the
+answer is also remembered across runs, keyed by port and uuid: device
+info is still read, one round trip telling which module is on the port,
+and the rest is taken from the cache entry of that uuid if there is one.
+identity(refresh=True) re-queries everything and replaces the entry."""
+        if not refresh and all(key in self.state for key in EBI.IDENTITY):
+            return { key: self.state[key] for key in EBI.IDENTITY }
+        with self._lock:
+            ret = self.device_info()
+            cached = None if refresh else self._load_identity(ret['uuid'])
+            if cached is None:
+                ret.update(self.firmware_version())
+                self._save_identity(ret)
+            else:
+                ret = cached
+        self.state.update(ret)
+        return dict(ret)
+    def _cached_identities(self):
+        "{port: {uuid: identity}} out of the identity cache file"
+        try:
+            with open(self.identity_cache, encoding='utf8') as cache:
+                data = json.load(cache)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+    def _load_identity(self, uuid):
+        if not self.identity_cache:
+            return None
+        entries = self._cached_identities().get(self.dev)
+        ret = entries.get(uuid) if isinstance(entries, dict) else None
+        if not isinstance(ret, dict) or any(key not in ret for key in EBI.IDENTITY):
+            return None
+        return { key: ret[key] for key in EBI.IDENTITY }
+    def _save_identity(self, ret):
+        if not self.identity_cache:
+            return
+        data = self._cached_identities()
+        entries = data.get(self.dev)
+        if not isinstance(entries, dict) or 'uuid' in entries: # older format, one per port
+            entries = data[self.dev] = {}
+        entries[ret['uuid']] = ret
+        tmp = f"{self.identity_cache}.{os.getpid()}"
+        try:
+            with open(tmp, 'w', encoding='utf8') as cache:
+                json.dump(data, cache, indent=1)
+            os.replace(tmp, self.identity_cache)
+        except OSError:
+            pass
+    def _get(self, code, timeout=None):
+        "query a COMMANDS entry and decode its answer"
+        command = EBI.COMMANDS[code]
+        return command.decode(self._send(command.prefix, timeout=timeout))
+    def _set(self, code, **values):
+        "write the request of a COMMANDS entry; returns the raw answer"
+        command = EBI.COMMANDS[code]
+        return self._send(command.prefix, command.request.encode(values))
     def device_info(self):
         "get device info (uuid, type, protocol)"
-        ans = self._send([0x01])
-        return {
-            'ebi_protocol': EBI.PROTOCOL.get(ans[0], None),
-            'embit_module': EBI.EMBIT_MODULE.get(ans[1], None),
-            'uuid': self.hex(ans[2:]),
-        }
+        return self._get(0x01)
     def device_state(self):
         "get device state"
-        ans = self._send([0x04])
-        return { 'state': EBI.DEVICE_STATE.get(ans[0], None) }
+        return self._get(0x04)
     def reset(self):
         "reset device"
-        ans = self._send([0x05])
-        _timeout = self.ser.timeout
-        self.ser.timeout = 3
-        boot = self._read()
-        self.ser.timeout = _timeout
-        assert boot[0] == 0x84
-        self.state['state'] = boot[1]
-        return {
-            'status': EBI.STATUS.get(ans[0],ans[0]),
-            'boot_state': EBI.DEVICE_STATE.get(boot[1], None)
-        }
+        with self._lock:
+            waiter = self._expect(0x84)
+            ans = self._get(0x05)
+            boot = self._wait(0x84, waiter, 3)
+        if boot[0] != 0x84:
+            raise UnexpectedResponse(f"expected boot notification, got {self.hex(boot)}")
+        self.invalidate()
+        self.state['state'] = EBI.DEVICE_STATE.get(boot[1], None)
+        ans['boot_state'] = EBI.DEVICE_STATE.get(boot[1], None)
+        return ans
     def firmware_version(self):
         "get firmware version"
-        ans = self._send([0x06])
-        return { 'firmware_version': self.hex(ans) }
-    def output_power(self, power=None):
+        return self._get(0x06)
+    def output_power(self, power=None, refresh=False):
         "get or set output power"
-        req_power = []
         try:
-            req_power = [int(power) % 256]
-        except ValueError:
-            pass
-        ans = self._send([0x10]+req_power)
-        if req_power:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        return { 'power': ans[0] }
+            power = int(power) % 256
+        except (TypeError, ValueError):
+            return self._cached('output_power', refresh) or \
+                self._store('output_power', self._get(0x10))
+        return self._written('output_power', self._set(0x10, power=power), { 'power': power })
     def operating_channel(
-        self, channel=None, spreading_factor=None, bandwidth=None, coding_rate=None
+        self, channel=None, spreading_factor=None, bandwidth=None, coding_rate=None,
+        refresh=False
     ):
         "get or set radio modulation parameter"
-        req_channel = []
         if channel in EBI.LORA_CHANNEL and spreading_factor in EBI.LORA_SPREADING_FACTOR and \
             bandwidth in EBI.LORA_BANDWIDTH and coding_rate in EBI.LORA_CODING_RATE:
-            req_channel = [channel, spreading_factor, bandwidth, coding_rate]
-        ans = self._send([0x11] + req_channel)
-        if req_channel:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        return { 'channel': ans[0] }
-    def energy_save(self, policy=None):
+            values = {
+                'channel': channel, 'spreading_factor': spreading_factor,
+                'bandwidth': bandwidth, 'coding_rate': coding_rate,
+            }
+            return self._written('operating_channel', self._set(0x11, **values), values)
+        return self._cached('operating_channel', refresh) or \
+            self._store('operating_channel', self._get(0x11))
+    def energy_save(self, policy=None, refresh=False):
         "get or set energy save policy"
-        req_policy = []
         if policy in EBI.MODULE_SLEEP_POLICY:
-            req_policy = [policy]
-        ans = self._send([0x13] + req_policy)
-        if req_policy:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        return { 'policy': EBI.MODULE_SLEEP_POLICY.get(ans[0], ans[0]) }
-    def network_address(self, address=None):
+            return self._written('energy_save', self._set(0x13, policy=policy), {
+                'policy': EBI.MODULE_SLEEP_POLICY[policy]
+            })
+        return self._cached('energy_save', refresh) or \
+            self._store('energy_save', self._get(0x13))
+    def network_address(self, address=None, refresh=False):
         "get or set network address"
-        req_address = []
         if address and len(address) in [2,4]:
-            req_address = address
-        ans = self._send([0x21] + req_address)
-        if req_address:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        return { 'address': self.hex(ans) }
-    def network_identifier(self, identifier=None):
+            return self._written('network_address', self._set(0x21, address=address), {
+                'address': self.hex(address)
+            })
+        return self._cached('network_address', refresh) or \
+            self._store('network_address', self._get(0x21))
+    def network_identifier(self, identifier=None, refresh=False):
         "get or set network identifier"
-        req_identifier = []
         if identifier and len(identifier) in [2,4]:
-            req_identifier = identifier
-        ans = self._send([0x22] + req_identifier)
-        if req_identifier:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        return { 'identifier': self.hex(ans) }
-    def network_preference(self, protocol=None, auto_join=None, adr=None):
+            return self._written('network_identifier', self._set(0x22, identifier=identifier), {
+                'identifier': self.hex(identifier)
+            })
+        return self._cached('network_identifier', refresh) or \
+            self._store('network_identifier', self._get(0x22))
+    def network_preference(self, protocol=None, auto_join=None, adr=None, refresh=False):
         "get or set network preference"
-        req_preference = []
         if protocol in [0,1] and auto_join in [0,1] and adr in [0,1]:
-            req_preference = [(protocol << 7) + (auto_join << 6) + (adr << 5)]
-        ans = self._send([0x25] + req_preference)
-        if req_preference:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        protocol = 'LoRaWAN' if ans[0] & 0x80 else 'LoRaEMB'
-        auto_join = (ans[0] & 0x40) != 0
-        adr = (ans[0] & 0x20) != 0
-        self.state['ebi_protocol'] = EBI.PROTOCOL.get(protocol)
-        return { 'protocol': protocol, 'auto_join': auto_join, 'adr': adr }
+            preference = (protocol << 7) + (auto_join << 6) + (adr << 5)
+            return self._written(
+                'network_preference', self._set(0x25, preference=preference),
+                EBI.COMMANDS[0x25].view(preference)
+            )
+        return self._cached('network_preference', refresh) or \
+            self._store('network_preference', self._get(0x25))
     def network_stop(self):
         "stop network"
-        ans = self._send([0x30])
-        return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
+        return self._get(0x30)
     def network_start(self):
         "start network"
-        _timeout = self.ser.timeout
-        self.ser.timeout = 3
-        ans = self._send([0x31])
-        self.ser.timeout = _timeout
-        return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-    def send_data(self, payload, protocol=0, dst=None, port=1):
-        "send data"
+        return self._get(0x31, timeout=3)
+    @staticmethod
+    def _data_request(payload, protocol, dst, port):
+        "send_data request body"
         assert protocol in [0,1]
         if protocol == 0: # LoRaEMB
-            options = [0x00, 0x00]
             if dst is None:
                 dst = [0xff, 0xff]
             assert len(dst)==2
-            header = options + dst
-        else: # LoRaWAN
-            assert port in range(1,224)
-            options = [0x09, 0x00]
-            header = options + [port]
-        ans = self._send([0x50] + header + payload)
+            return EBI.COMMANDS[0x50].request.encode({
+                'options': 0x0000, 'dst': (dst[0] << 8) + dst[1], 'payload': payload
+            })
+        assert port in range(1,224) # LoRaWAN
+        return EBI.SEND_DATA_LORAWAN.encode({ 'options': 0x0900, 'port': port, 'payload': payload })
+    def send_data(self, payload, protocol=0, dst=None, port=1):
+        "send data"
+        if self.codec:
+            payload = self.codec.encode(payload)
+        command = EBI.COMMANDS[0x50]
+        ans = self._send(command.prefix, self._data_request(payload, protocol, dst, port))
+        return command.decode(ans)
+    def submit(self, payload, protocol=0, dst=None, port=1, priority=0, ttl=None):
+        """queue send_data without waiting; returns a Future of its TxResult
+
+A single worker thread sends the queued payloads, higher priorities
+first and equal ones in order. A payload already waiting for the same
+destination is not queued twice: its future is returned, its priority
+raised if needed. Payloads still waiting ttl seconds after submission
+are dropped and their future cancelled, as are those left at close()."""
+        payload = bytes(payload)
+        target = (tuple(dst) if dst else None) if protocol == 0 else port
+        key = (protocol, target, payload)
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._tx_cond:
+            if self._tx_closed.is_set():
+                raise EBIError("closed")
+            submission = self._tx_pending.get(key)
+            if submission is None:
+                kwargs = { 'protocol': protocol, 'dst': dst, 'port': port }
+                submission = self._tx_pending[key] = Submission(key, payload, kwargs, expires)
+            else:
+                self.tx_coalesced += 1
+                if submission.expires is not None and expires is not None:
+                    submission.expires = max(expires, submission.expires)
+                else:
+                    submission.expires = None
+            heapq.heappush(self._tx_queue, (-priority, next(self._tx_order), submission))
+            if self._tx_worker is None:
+                self._tx_worker = threading.Thread(
+                    target=EBI._tx_loop,
+                    args=(weakref.ref(self), self._tx_cond, self._tx_queue, self._tx_closed),
+                    name=f"ebi-tx {self.dev}", daemon=True
+                )
+                self._tx_worker.start()
+            self._tx_cond.notify()
+        return submission.future
+    @property
+    def tx_pending(self):
+        "payloads waiting in the submit queue"
+        return len(self._tx_pending)
+    @staticmethod
+    def _tx_loop(ref, cond, tx_queue, closed):
+        # like the reader, the EBI is only referenced while a submission is handled
+        while True:
+            with cond:
+                cond.wait_for(lambda: tx_queue or closed.is_set(), 1)
+            ebi = ref()
+            if ebi is None or not ebi._tx_next():
+                return
+            del ebi
+    def _tx_next(self):
+        "send the first queued submission, if any; False once closed"
+        with self._tx_cond:
+            if self._tx_closed.is_set():
+                return False
+            if not self._tx_queue:
+                return True
+            _, _, submission = heapq.heappop(self._tx_queue)
+            # a coalesced submission has one queue entry per submit, only the first counts
+            if self._tx_pending.get(submission.key) is not submission:
+                return True
+            del self._tx_pending[submission.key]
+        if submission.expires is not None and time.monotonic() > submission.expires:
+            self.tx_expired += 1
+            submission.future.cancel()
+            return True
+        if not submission.future.set_running_or_notify_cancel():
+            return True
+        try:
+            submission.future.set_result(self.send_data(submission.payload, **submission.kwargs))
+        except Exception as exc: # pylint: disable=broad-except
+            submission.future.set_exception(exc)
+        return True
+    def send_blob(self, dst, data, **kwargs):
+        """send data of any length to the module at dst, see blob.BlobSender
+
+Returns the number of windows it took. The EBIError raised if it fails
+has the transfer id in ident: send_blob(dst, data, ident=exc.ident)
+resumes it."""
+        import blob # pylint: disable=import-outside-toplevel
+        return blob.BlobSender(self, dst, data, **kwargs).run()
+    def receive_blob(self, timeout=None, other=None, linger=0):
+        """wait for a blob sent with send_blob; returns (src, data), None on timeout
+
+Packets received meanwhile that are not part of a transfer are passed
+to other, dropped without it. Senders are only answered while this
+runs: linger keeps answering that many seconds after a blob is in, for
+a sender whose final acknowledgement was lost; without it, that sender
+raises Timeout although the blob arrived."""
+        import blob # pylint: disable=import-outside-toplevel
+        if self._blobs is None:
+            self._blobs = blob.BlobReceiver(self)
+        self._blobs.other = other
+        received = self._blobs.receive(timeout)
+        if linger:
+            self._blobs.linger(linger)
+        return received
+    @staticmethod
+    def _check_config(
+        power=None, channel=None, policy=None, address=None,
+        identifier=None, preference=None, ieee=None
+    ):
+        "raise ValueError for a setting apply_config could not write"
+        def fail(name, value):
+            raise ValueError(f"invalid {name} {value!r}")
+        def octets(value, lengths):
+            try:
+                return len(value) in lengths and all(0 <= int(octet) <= 0xFF for octet in value)
+            except (TypeError, ValueError):
+                return False
+        if power is not None:
+            try:
+                int(power)
+            except (TypeError, ValueError):
+                fail('power', power)
+        tables = (
+            EBI.LORA_CHANNEL, EBI.LORA_SPREADING_FACTOR, EBI.LORA_BANDWIDTH, EBI.LORA_CODING_RATE
+        )
+        if channel is not None and (len(channel) != len(tables) or \
+            any(value not in table for value, table in zip(channel, tables))):
+            fail('channel', channel)
+        if policy is not None and policy not in EBI.MODULE_SLEEP_POLICY:
+            fail('policy', policy)
+        if address is not None and not octets(address, (2, 4)):
+            fail('address', address)
+        if identifier is not None and not octets(identifier, (2, 4)):
+            fail('identifier', identifier)
+        if preference is not None and (len(preference) != 3 or \
+            any(value not in (0, 1) for value in preference)):
+            fail('preference', preference)
+        if ieee is not None and not octets(ieee, (8,)):
+            fail('ieee', ieee)
+    def _config_changes(
+        self, power=None, channel=None, policy=None, address=None,
+        identifier=None, preference=None, ieee=None, refresh=False
+    ):
+        "(name, setter, args) of the settings that differ from the module's"
+        EBI._check_config(power, channel, policy, address, identifier, preference, ieee)
+        changes = []
+        if power is not None and self.output_power(refresh=refresh)['power'] != int(power) % 256:
+            changes.append(('power', self.output_power, [power]))
+        if channel is not None:
+            current = self.operating_channel(refresh=refresh)
+            keys = ('channel', 'spreading_factor', 'bandwidth', 'coding_rate')
+            if tuple(current.get(key) for key in keys) != tuple(channel):
+                changes.append(('channel', self.operating_channel, channel))
+        if policy is not None and self.energy_save(refresh=refresh)['policy'] != \
+            EBI.MODULE_SLEEP_POLICY.get(policy, policy):
+            changes.append(('policy', self.energy_save, [policy]))
+        if address is not None and \
+            self.network_address(refresh=refresh)['address'] != self.hex(address):
+            changes.append(('address', self.network_address, [address]))
+        if identifier is not None and \
+            self.network_identifier(refresh=refresh)['identifier'] != self.hex(identifier):
+            changes.append(('identifier', self.network_identifier, [identifier]))
+        if preference is not None:
+            current = self.network_preference(refresh=refresh)
+            protocol, auto_join, adr = preference
+            if (current['protocol'] == 'LoRaWAN', current['auto_join'], current['adr']) != \
+                (protocol == 1, auto_join == 1, adr == 1):
+                changes.append(('preference', self.network_preference, preference))
+        if ieee is not None and \
+            self.ieee_address(refresh=refresh)['ieee_address'] != self.hex(ieee):
+            changes.append(('ieee', self.ieee_address, [ieee]))
+        return changes
+    def apply_config(
+        self, power=None, channel=None, policy=None, address=None,
+        identifier=None, preference=None, ieee=None, start=False
+    ):
+        """bring the module to a configuration with as few round trips as possible
+
+channel is a (channel, spreading_factor, bandwidth, coding_rate) tuple,
+preference a (protocol, auto_join, adr) one and ieee the 8 byte IEEE
+address; settings left to None are not touched. Current values are read
+once and, only if something differs, the network is stopped, the
+changed settings written and the network started again, even if a
+write failed; with start the network is started anyway. Values are all
+checked first: ValueError leaves the module untouched. Returns the
+status of each setting written."""
+        with self._lock:
+            changes = self._config_changes(
+                power, channel, policy, address, identifier, preference, ieee
+            )
+            online = False
+            if changes or start:
+                online = self.device_state()['state'] == 'Online'
+            if changes and online:
+                self.network_stop()
+            results = {}
+            try:
+                for name, setter, args in changes:
+                    results[name] = setter(*args)['status']
+            finally:
+                if (changes and online) or (start and not online):
+                    self.network_start()
+            return results
+    def verify_config(
+        self, power=None, channel=None, policy=None, address=None,
+        identifier=None, preference=None, ieee=None
+    ):
+        "names of the settings, given as for apply_config, the module does not hold"
+        with self._lock:
+            return [name for name, _, _ in self._config_changes(
+                power, channel, policy, address, identifier, preference, ieee, refresh=True
+            )]
+    def ieee_address(self, mac=None, refresh=False):
+        "get or set IEEE address"
+        if mac:
+            assert len(mac) == 8
+            return self._written('ieee_address', self._set(0x7E, mac=mac), {
+                'ieee_address': self.hex(mac)
+            })
+        return self._cached('ieee_address', refresh) or \
+            self._store('ieee_address', self._get(0x7E))
+    def notification(self, code=None, timeout=None):
+        "get the next queued notification, optionally only those with the given code"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ans = self.notifications.get(remaining)
+            if ans is None or code is None or ans[0] == code:
+                return ans
+    def counters(self):
+        "received, dropped, corrupt and malformed frame counters"
+        return {
+            'received': self.rx.received,
+            'dropped': self.dropped,
+            'corrupt': self.corrupt,
+            'discarded': self.discarded,
+            'malformed': self.malformed,
+        }
+    def receive(self, protocol=0, timeout=None):
+        "listen for data"
+        ans = self.rx.get(timeout)
+        if not ans:
+            return None
+        stamp, frame = ans
+        return RxPacket(frame, protocol, self.codec, stamp)
+    def take(self, count, timeout=None, protocol=0):
+        "get up to count received packets, waiting at most timeout for them"
+        return [
+            RxPacket(frame, protocol, self.codec, stamp)
+            for stamp, frame in self.rx.take(count, timeout)
+        ]
+    def packets(self, protocol=0, timeout=None):
+        "iterate over received packets, until closed or nothing arrives within timeout"
+        while True:
+            packet = self.receive(protocol, timeout)
+            if packet is None:
+                return
+            yield packet
+
+class Frame(collections.abc.Mapping):
+    """Raw EBI frame decoded field by field on access
+
+Reads like the dict the library used to return: keys() lists the
+fields, self[key] formats them as before and extra keys can be set.
+A key is decoded alone; iterating, or setting a key, builds that dict
+once as a whole and the frame answers from it from then on. _keys()
+returns one of the precomputed tuples of field names and GETTERS maps
+each of them to the function of the frame formatting it."""
+    __slots__ = ('frame', '_dict')
+    KEYS = ()
+    GETTERS = {}
+    def __init__(self, frame):
+        self.frame = bytes(frame)
+        self._dict = None
+    def _keys(self):
+        return self.KEYS
+    def _as_dict(self):
+        "the dict the library used to return"
+        return { key: self[key] for key in self._keys() }
+    def _mapping(self):
+        if self._dict is None:
+            self._dict = self._as_dict()
+        return self._dict
+    def hex(self):
+        "raw frame as hexstring"
+        return hexstr(self.frame)
+    def keys(self):
+        "the field names, then the extra keys"
+        return self._mapping().keys()
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+        if key in self._keys():
+            return self.GETTERS[key](self)
+        raise KeyError(key)
+    def __setitem__(self, key, value):
+        self._mapping()[key] = value
+    def __iter__(self):
+        return iter(self._mapping())
+    def __len__(self):
+        return len(self._mapping())
+    def __repr__(self):
+        return repr(dict(self))
+
+class RxPacket(Frame):
+    """Received packet (0xE0 notification)
+
+With a codec, data is the payload it decodes; frame keeps the raw one.
+timestamp is the time.time() the reader got it from the port, if known."""
+    __slots__ = ('protocol', 'codec', 'timestamp')
+    LAYOUT = Layout('code:B options:H rssi:h src:H dst:H *data')
+    LORAWAN_LAYOUT = Layout('code:B options:H rssi:h port:B *data')
+    def __init__(self, frame, protocol=0, codec=None, timestamp=None):
+        Frame.__init__(self, frame)
+        self.protocol = protocol
+        self.codec = codec
+        self.timestamp = timestamp
+    KEYS = ('options', 'rssi')
+    PROTOCOL_KEYS = {
+        0: ('options', 'rssi', 'src', 'dst', 'data'),
+        1: ('options', 'rssi', 'port', 'data'),
+    }
+    def _keys(self):
+        return RxPacket.PROTOCOL_KEYS.get(self.protocol, RxPacket.KEYS)
+    def _as_dict(self):
+        frame = self.frame
+        if len(frame) < 9:
+            return Frame._as_dict(self)
+        rssi = (frame[3] << 8) + frame[4]
+        packet = {
+            'options': hexstr(frame[1:3]),
+            'rssi': rssi - 0x10000 if rssi & 0x8000 else rssi,
+        }
+        if self.protocol == 0:
+            packet['src'] = hexstr(frame[5:7])
+            packet['dst'] = hexstr(frame[7:9])
+            packet['data'] = self.data
+        elif self.protocol == 1:
+            packet['port'] = frame[5]
+            packet['data'] = self.data
+        return packet
+    options = LAYOUT.field('options', doc="options field")
+    rssi = LAYOUT.field('rssi', doc="signed RSSI")
+    src = LAYOUT.field('src', doc="LoRaEMB source address")
+    dst = LAYOUT.field('dst', doc="LoRaEMB destination address")
+    port = LORAWAN_LAYOUT.field('port', doc="LoRaWAN port")
+    def _data(self, start=LAYOUT.struct.size, lorawan_start=LORAWAN_LAYOUT.struct.size):
+        data = self.frame[start if self.protocol == 0 else lorawan_start:]
+        return self.codec.decode(data) if self.codec else data
+    data = property(_data, doc="payload")
+    GETTERS = {
+        'options': lambda packet: hexstr(packet.frame[1:3]),
+        'rssi': rssi.fget,
+        'src': lambda packet: hexstr(packet.frame[5:7]),
+        'dst': lambda packet: hexstr(packet.frame[7:9]),
+        'port': port.fget,
+        'data': _data,
+    }
+
+class TxResult(Frame):
+    """send_data outcome (0xD0 response)"""
+    __slots__ = ()
+    LAYOUT = Layout(
+        'status:B retries:B rssi:h tx_channel_mask:H tx_datarate_mask:B tx_power:B waiting_time:I'
+    )
+    KEYS = ('status', 'retries', 'RSSI')
+    # keys of a successful send by frame length, the last one for longer frames
+    SUCCESS_KEYS = (KEYS,) * 6 + (
+        KEYS + ('tx_channel_mask',),
+        KEYS + ('tx_channel_mask', 'tx_datarate_mask'),
+    ) + (KEYS + ('tx_channel_mask', 'tx_datarate_mask', 'tx_power'),) * 4 + (
+        KEYS + ('tx_channel_mask', 'tx_datarate_mask', 'tx_power', 'waiting_time'),
+        KEYS + ('tx_channel_mask', 'tx_datarate_mask', 'tx_power'),
+    )
+    def _keys(self):
+        frame = self.frame
+        if frame[0] != 0x00:
+            return TxResult.KEYS
+        return TxResult.SUCCESS_KEYS[len(frame) if len(frame) < 13 else 13]
+    def _as_dict(self):
+        ans = self.frame
+        if len(ans) < 4:
+            return Frame._as_dict(self)
         result = {
-            'status':          EBI.STATUS.get(ans[0],ans[0]),
-            'retries':         ans[1],
-            'RSSI':            (ans[2] << 8) + ans[3],
+            'status': EBI.STATUS.get(ans[0], ans[0]),
+            'retries': ans[1],
+            'RSSI': (ans[2] << 8) + ans[3],
         }
-        if result['status'] == 'Success':
+        if ans[0] == 0x00:
             if len(ans) >= 6:
                 result['tx_channel_mask'] = (ans[4] << 8) + ans[5]
             if len(ans) >= 7:
@@ -272,41 +1300,36 @@ class EBI:
             if len(ans) == 12:
                 result['waiting_time'] = (ans[8] << 24) + (ans[9] << 16) + (ans[10] << 8) + ans[11]
         return result
-    def ieee_address(self, mac=None):
-        "get or set IEEE address"
-        req_mac = []
-        if mac:
-            assert len(mac) == 8
-            req_mac = mac
-        ans = self._send([0x7e, 0x20] + req_mac)
-        if req_mac:
-            return { 'status': EBI.STATUS.get(ans[0],ans[0]) }
-        return { 'ieee_address': self.hex(ans) }
-    def receive(self, protocol=0, timeout=None):
-        "listen for data"
-        _timeout = self.ser.timeout
-        self.ser.timeout = timeout
-        ans = self._read()
-        self.ser.timeout = _timeout
-        if not ans:
-            return None
-        assert ans[0] == 0xe0
-        def signed(num, bits):
-            if num & (1 <<(bits -1)):
-                return num - (1 << bits)
-            return num
-        packet = {
-            'options': self.hex(ans[1:3]),
-            'rssi': signed((ans[3] << 8) + ans[4], 16),
-        }
-        if protocol == 0:
-            packet['src'] = self.hex(ans[5:7])
-            packet['dst'] = self.hex(ans[7:9])
-            packet['data'] = bytes(ans[9:])
-        elif protocol == 1:
-            packet['port'] = ans[5]
-            packet['data'] = bytes(ans[6:])
-        return packet
+    status_code = LAYOUT.field('status', doc="raw status")
+    retries = LAYOUT.field('retries', doc="retransmissions needed")
+    rssi = LAYOUT.field('rssi', doc="signed RSSI of the acknowledgement")
+    tx_channel_mask = LAYOUT.field(
+        'tx_channel_mask', doc="channels used for the transmission, None if not reported"
+    )
+    tx_datarate_mask = LAYOUT.field(
+        'tx_datarate_mask', doc="data rates used for the transmission, None if not reported"
+    )
+    tx_power = LAYOUT.field('tx_power', doc="transmission power, None if not reported")
+    waiting_time = LAYOUT.field(
+        'waiting_time', doc="time before the next transmission is allowed, None if not reported"
+    )
+    @property
+    def status(self):
+        "status description"
+        return EBI.STATUS.get(self.frame[0], self.frame[0])
+    @property
+    def ok(self):
+        "True if the module accepted the data"
+        return self.frame[0] == 0x00
+    GETTERS = {
+        'status': status.fget,
+        'retries': retries.fget,
+        'RSSI': lambda result: (result.frame[2] << 8) + result.frame[3],
+        'tx_channel_mask': tx_channel_mask.fget,
+        'tx_datarate_mask': tx_datarate_mask.fget,
+        'tx_power': tx_power.fget,
+        'waiting_time': waiting_time.fget,
+    }
 
 if __name__ == "__main__":
     DEVICE = "/dev/ttyUSB0"
@@ -340,3 +1363,4 @@ if __name__ == "__main__":
     print("SEND DATA 01:02:03:04:", e.send_data(payload=[1,2,3,4]))
     print("NETWORK STOP:", e.network_stop())
     print("IEEE ADDRESS:", e.ieee_address())
+    e.close()
@@ -5,6 +5,9 @@ import cmd
 import sys
 import shlex
 from ebi import EBI
+from capture import CaptureWriter
+from compress import Codec
+from mux import MuxClient, is_socket
 
 class EmbitShell(cmd.Cmd):
     """EBI Command shell"""
@@ -12,28 +15,31 @@ class EmbitShell(cmd.Cmd):
 
     def __init__(self, device, debug=True):
         self.debug = debug
+        self._capture = None
         if self.debug:
             print("---Start Init")
-        self._e = EBI(device)
-        if self.debug:
-            print("---Start Reset")
-        self._e.reset()
-        state = self._e.state
-        self.intro = "EMBIT module {embit_module} - FW {firmware_version}\n".format(**state)
-        if state['state'] == 'Online':
-            self._e.network_stop()
-        if self.debug:
-            print("---Energy save")
-        # Always on
-        self._e.energy_save(0x00)
+        # a multiplexer socket: attach to the running module and leave it as it is
+        attach = is_socket(device)
+        self._e = MuxClient(device, lazy=True) if attach else EBI(device, lazy=True)
+        if not attach:
+            if self.debug:
+                print("---Start Reset")
+            self._e.reset()
+        identity = self._e.identity()
+        self.intro = "EMBIT module {embit_module} - FW {firmware_version}\n".format(**identity)
         # 868.100 MHz, 128 Chips/symbol, 125 kHz, 4/5
         self._params = { 'channel': 1, 'sf': 7, 'bw': 0, 'cr': 1 }
-        if self.debug:
-            print("---Operating channel")
-        self._e.operating_channel(*self._params.values())
-        if self.debug:
-            print("---Start Network")
-        self._e.network_start()
+        if attach:
+            channel = self._e.operating_channel()
+            self._params = {
+                'channel': channel['channel'], 'sf': channel.get('spreading_factor', 7),
+                'bw': channel.get('bandwidth', 0), 'cr': channel.get('coding_rate', 1),
+            }
+        else:
+            if self.debug:
+                print("---Configure and start network")
+            # Always on
+            self._e.apply_config(policy=0x00, channel=tuple(self._params.values()), start=True)
         super().__init__()
 
     def default(self, line):
@@ -47,7 +53,37 @@ class EmbitShell(cmd.Cmd):
 Usage: debug"""
         # pylint: disable=unused-argument
         self._e.debug = not self._e.debug
-        print(f"{'debug': {self._e.debug}}")
+        print({ 'debug': self._e.debug })
+
+    def do_capture(self, arg):
+        """capture frames to a binary file, see capture.py to decode it
+Usage: capture [file | off]"""
+        if self._capture is not None:
+            if self._e.tap is self._capture:
+                self._e.tap = None
+            self._capture.close()
+            self._capture = None
+        if arg and arg != 'off':
+            self._capture = CaptureWriter(arg)
+            self._e.tap = self._capture
+        print({ 'capture': arg if self._capture else 'off' })
+
+    def do_codec(self, arg):
+        """compress sent and decompress received payloads with a shared dictionary
+Usage: codec [dictionary_file | plain | off]"""
+        if arg == 'off':
+            self._e.codec = None
+        elif arg == 'plain':
+            self._e.codec = Codec()
+        elif arg:
+            try:
+                with open(arg, 'rb') as dictionary:
+                    self._e.codec = Codec(dictionary.read())
+            except OSError as exc:
+                print(f"Cannot read dictionary: {exc}")
+                return
+        codec = self._e.codec
+        print({ 'codec': f"{len(codec.dictionary)} byte dictionary" if codec else 'off' })
 
     def do_state(self, arg):
         """get device state
@@ -75,13 +111,10 @@ value: [0-256]"""
             except ValueError:
                 print(f"Invalid power value {arg}")
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
-        if should_stop:
-            self._e.network_stop()
-        ret = self._e.output_power(value)
-        if should_stop:
-            self._e.network_start()
+        if value is None:
+            ret = self._e.output_power()
+        else:
+            ret = { 'status': self._e.apply_config(power=value).get('power', 'Success') }
         print(ret)
 
     def do_channel(self, arg):
@@ -107,41 +140,28 @@ cr: 0x01 -> 4/5
         channel, spreading_factor, bandwidth, coding_rate = [None]*4
         args = (arg.split() + [""]*4)[:4]
         if args[0]:
-            try:
-                channel = EBI.LORA_CHANNEL[int(args[0])]
-            except (ValueError, KeyError):
-                print(f"Invalid channel value {args[0]}")
-                return
-            try:
-                spreading_factor = EBI.LORA_SPREADING_FACTOR[int(args[1])]
-            except (ValueError, KeyError):
-                print(f"Invalid spreading factor value {args[1]}")
-                return
-            try:
-                bandwidth = EBI.LORA_BANDWIDTH[int(args[2])]
-            except (ValueError, KeyError):
-                print(f"Invalid bandwith value {args[2]}")
-                return
-            try:
-                coding_rate = EBI.LORA_CODING_RATE[int(args[3])]
-            except (ValueError, KeyError):
-                print(f"Invalid coding rate value {args[3]}")
-                return
-        state = self._e.device_state()
-        should_stop = channel and state['state'] == 'Online'
-        if should_stop:
-            self._e.network_stop()
-        ret = self._e.operating_channel(channel, spreading_factor, bandwidth, coding_rate)
-        if channel and ret.get('status','') == 'Success':
-            self._params = {
-                'channel': channel, 'sf': spreading_factor,
-                'bw': bandwidth, 'cr': coding_rate,
-            }
-        if 'channel' in ret:
-            assert ret['channel'] == self._params['channel']
+            values = []
+            for value, table, name in zip(args, (
+                EBI.LORA_CHANNEL, EBI.LORA_SPREADING_FACTOR,
+                EBI.LORA_BANDWIDTH, EBI.LORA_CODING_RATE,
+            ), ('channel', 'spreading factor', 'bandwith', 'coding rate')):
+                try:
+                    number = int(value, 0)
+                except ValueError:
+                    number = None
+                if number not in table:
+                    print(f"Invalid {name} value {value}")
+                    return
+                values.append(number)
+            channel, spreading_factor, bandwidth, coding_rate = values
+        if channel is None:
+            ret = self._e.operating_channel()
+        else:
+            params = (channel, spreading_factor, bandwidth, coding_rate)
+            ret = { 'status': self._e.apply_config(channel=params).get('channel', 'Success') }
+            if ret['status'] == 'Success':
+                self._params = dict(zip(self._params, params))
         ret.update(self._params)
-        if should_stop:
-            self._e.network_start()
         print(ret)
 
     def do_address(self, arg):
@@ -157,13 +177,10 @@ value: [0-65535]"""
             except ValueError:
                 print(f"Invalid address value {arg}")
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
-        if should_stop:
-            self._e.network_stop()
-        ret = self._e.network_address(value)
-        if should_stop:
-            self._e.network_start()
+        if value is None:
+            ret = self._e.network_address()
+        else:
+            ret = { 'status': self._e.apply_config(address=value).get('address', 'Success') }
         print(ret)
 
     def do_network(self, arg):
@@ -179,13 +196,10 @@ value: [0-65535]"""
             except ValueError:
                 print(f"Invalid network value {arg}")
                 return
-        state = self._e.device_state()
-        should_stop = value and state['state'] == 'Online'
-        if should_stop:
-            self._e.network_stop()
-        ret = self._e.network_identifier(value)
-        if should_stop:
-            self._e.network_start()
+        if value is None:
+            ret = self._e.network_identifier()
+        else:
+            ret = { 'status': self._e.apply_config(identifier=value).get('identifier', 'Success') }
         print(ret)
 
     def do_send(self, arg):
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+"""
+EMB-LR1276 emulator: pseudo-terminals speaking EBI over a simulated radio.
+
+Every EmulatedModule exposes a pty that EBI can open like /dev/ttyUSB0.
+Modules share a Radio that delivers LoRaEMB frames between modules on
+the same channel, spreading factor, bandwidth and network identifier,
+after the time on air computed by lora.time_on_air. Overlapping
+transmissions on the same channel and spreading factor collide and are
+both lost; loss drops a share of the remaining ones at random.
+time_scale stretches (>1) or compresses (<1) every delay.
+"""
+
+import heapq
+import itertools
+import os
+import pty
+import random
+import sys
+import threading
+import time
+import tty
+from ebi import FrameDecoder, FrameEncoder
+import lora
+
+class Radio:
+    """Shared radio medium with a scheduler for delayed events"""
+    def __init__(self, time_scale=1.0, loss=0.0, rssi=-60, seed=None):
+        self.time_scale = time_scale
+        self.loss = loss
+        self.rssi = rssi
+        self.modules = []
+        self.delivered = 0
+        self.collided = 0
+        self.lost = 0
+        self._random = random.Random(seed)
+        self._air = []
+        self._events = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="radio", daemon=True)
+        self._thread.start()
+    def close(self):
+        "stop the scheduler and every attached module"
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        for module in self.modules:
+            module.close()
+    def after(self, delay, callback, *args):
+        "run callback after delay (emulated seconds) on the scheduler thread"
+        when = time.monotonic() + delay * self.time_scale
+        with self._cond:
+            heapq.heappush(self._events, (when, next(self._counter), callback, args))
+            self._cond.notify()
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._running and (
+                    not self._events or self._events[0][0] > time.monotonic()
+                ):
+                    timeout = self._events[0][0] - time.monotonic() if self._events else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                _, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+    def transmit(self, sender, dst, data):
+        "put a frame on the air; returns its time on air in emulated seconds"
+        toa = lora.time_on_air(len(data) + lora.OVERHEAD[0], sender.sf, sender.bw, sender.cr)
+        now = time.monotonic()
+        tx = {
+            'sender': sender, 'dst': dst, 'data': bytes(data), 'collided': False,
+            'channel': sender.channel, 'sf': sender.sf, 'bw': sender.bw,
+            'end': now + toa * self.time_scale,
+        }
+        with self._cond:
+            self._air = [other for other in self._air if other['end'] > now]
+            for other in self._air:
+                if (other['channel'], other['sf']) == (tx['channel'], tx['sf']):
+                    other['collided'] = tx['collided'] = True
+            self._air.append(tx)
+        self.after(toa, self._deliver, tx)
+        return toa
+    def _deliver(self, tx):
+        if tx['collided']:
+            self.collided += 1
+            return
+        if self._random.random() < self.loss:
+            self.lost += 1
+            return
+        sender = tx['sender']
+        for module in self.modules:
+            if module is not sender and module.hears(sender, tx['dst']):
+                module.notify_rx(sender.address, tx['dst'], tx['data'], self.rssi)
+                self.delivered += 1
+
+class EmulatedModule:
+    """One emulated EMB-LR1276 behind a pty"""
+    ONLINE = 0x30
+    OFFLINE = 0x20
+    READY = 0x10
+    def __init__(self, radio, index=0, command_latency=0.005, boot_time=0.2):
+        self.radio = radio
+        self.index = index
+        self.command_latency = command_latency
+        self.boot_time = boot_time
+        self.uuid = bytes([0x00, 0x01, 0x02, 0x03, 0x04, 0x05, index >> 8 & 0xFF, index & 0xFF])
+        self._defaults()
+        self._lock = threading.Lock()
+        self._encoder = FrameEncoder()
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        radio.modules.append(self)
+        self._thread = threading.Thread(
+            target=self._loop, name=f"emulator {self.port}", daemon=True
+        )
+        self._thread.start()
+    def _defaults(self):
+        self.state = EmulatedModule.OFFLINE
+        self.power = 14
+        self.channel, self.sf, self.bw, self.cr = 0x01, 0x07, 0x00, 0x01
+        self.policy = 0x00
+        self.address = (self.index + 1) & 0xFFFF
+        self.identifier = 0x0001
+        self.preference = 0x00
+        self.ieee = bytes(8 - len(self.uuid)) + self.uuid
+        self.tx_until = 0.0
+        self.rx_until = 0.0
+    def close(self):
+        "close both pty ends"
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    def _write(self, body):
+        with self._lock:
+            try:
+                os.write(self._master, self._encoder.encode(body))
+            except OSError:
+                pass
+    def _reply(self, body):
+        self.radio.after(self.command_latency, self._write, body)
+    def _loop(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            for frame in decoder.feed(data):
+                self._handle(bytes(frame[2:-1]))
+    def hears(self, sender, dst):
+        "whether a transmission from sender to dst reaches this module"
+        now = time.monotonic()
+        if self.state != EmulatedModule.ONLINE or self.tx_until > now:
+            return False
+        if self.policy == 0x02 or (self.policy == 0x01 and self.rx_until < now):
+            return False
+        if (self.channel, self.sf, self.bw, self.identifier) != \
+            (sender.channel, sender.sf, sender.bw, sender.identifier):
+            return False
+        return dst in (0xFFFF, self.address)
+    def notify_rx(self, src, dst, data, rssi):
+        "deliver a received frame to the host as a 0xE0 notification"
+        self._write(
+            [0xE0, 0x00, 0x00, rssi >> 8 & 0xFF, rssi & 0xFF,
+             src >> 8, src & 0xFF, dst >> 8, dst & 0xFF] + list(data)
+        )
+    def _handle(self, body):
+        # pylint: disable=too-many-branches
+        code, params = body[0], body[1:]
+        answer = code | 0x80
+        if code == 0x01:
+            self._reply([answer, 0x50, 0x55] + list(self.uuid))
+        elif code == 0x04:
+            self._reply([answer, self.state])
+        elif code == 0x05:
+            self._reply([answer, 0x00])
+            self._defaults()
+            self.radio.after(self.command_latency + self.boot_time, self._write, [0x84, self.READY])
+        elif code == 0x06:
+            self._reply([answer, 0x01, 0x02, 0x03, 0x04])
+        elif code == 0x10:
+            self._setting(answer, params, 1, 'power')
+        elif code == 0x11:
+            if params:
+                ok = len(params) == 4 and params[0] in (1, 2, 3, 4) and 7 <= params[1] <= 12 \
+                    and params[2] in lora.BANDWIDTH_HZ and 1 <= params[3] <= 4
+                if ok and self.state != EmulatedModule.ONLINE:
+                    self.channel, self.sf, self.bw, self.cr = params
+                self._status(answer, ok)
+            else:
+                self._reply([answer, self.channel, self.sf, self.bw, self.cr])
+        elif code == 0x13:
+            self._setting(answer, params, 1, 'policy')
+        elif code == 0x21:
+            self._setting(answer, params, 2, 'address')
+        elif code == 0x22:
+            self._setting(answer, params, 2, 'identifier')
+        elif code == 0x25:
+            self._setting(answer, params, 1, 'preference')
+        elif code == 0x30:
+            self.state = EmulatedModule.OFFLINE
+            self._reply([answer, 0x00])
+        elif code == 0x31:
+            self.state = EmulatedModule.ONLINE
+            self._reply([answer, 0x00])
+        elif code == 0x50:
+            self._send_data(answer, params)
+        elif code == 0x7E and params[:1] == b'\x20':
+            if len(params) == 9:
+                self.ieee = params[1:]
+                self._reply([answer, 0x00])
+            else:
+                self._reply([answer] + list(self.ieee))
+        else:
+            self._reply([answer, 0x05])
+    def _status(self, answer, ok):
+        if ok and self.state == EmulatedModule.ONLINE:
+            self._reply([answer, 0x06])
+        else:
+            self._reply([answer, 0x00 if ok else 0x02])
+    def _setting(self, answer, params, size, name):
+        if not params:
+            value = getattr(self, name)
+            self._reply([answer] + list(value.to_bytes(size, 'big')))
+            return
+        ok = len(params) == size
+        if ok and self.state != EmulatedModule.ONLINE:
+            setattr(self, name, int.from_bytes(params, 'big'))
+        self._status(answer, ok)
+    def _send_data(self, answer, params):
+        now = time.monotonic()
+        if self.state != EmulatedModule.ONLINE:
+            self._reply([answer, 0x07, 0x00, 0x00, 0x00])
+            return
+        if self.tx_until > now:
+            self._reply([answer, 0x06, 0x00, 0x00, 0x00])
+            return
+        if self.preference & 0x80: # LoRaWAN uplink, nobody here to hear it
+            dst, data = None, params[3:]
+        else:
+            dst, data = int.from_bytes(params[2:4], 'big'), params[4:]
+        if len(data) > lora.max_payload(self.sf):
+            self._reply([answer, 0x02, 0x00, 0x00, 0x00])
+            return
+        if dst is None:
+            toa = lora.time_on_air(len(data) + lora.OVERHEAD[1], self.sf, self.bw, self.cr)
+        else:
+            toa = self.radio.transmit(self, dst, data)
+        self.tx_until = now + toa * self.radio.time_scale
+        self.rx_until = self.tx_until + 1.0 * self.radio.time_scale
+        self.radio.after(toa, self._write, [answer, 0x00, 0x00, 0x00, 0x00])
+
+def emulate(count=2, time_scale=1.0, loss=0.0, seed=None):
+    "build a radio with count modules on it"
+    radio = Radio(time_scale=time_scale, loss=loss, seed=seed)
+    for index in range(count):
+        EmulatedModule(radio, index)
+    return radio
+
+if __name__ == "__main__":
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    TIME_SCALE = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    LOSS = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    RADIO = emulate(COUNT, TIME_SCALE, LOSS)
+    for MODULE in RADIO.modules:
+        print(f"module {MODULE.index}: {MODULE.port} address {MODULE.address:04x}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"delivered {RADIO.delivered}, collided {RADIO.collided}, lost {RADIO.lost}")
+    except KeyboardInterrupt:
+        RADIO.close()
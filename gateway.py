@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+""" EBI gateway: a pool of modules behind one host """
+
+import sys
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ebi import EBI
+
+class Gateway:
+    """Pool of EBI modules with fan-out TX and a merged RX stream"""
+    def __init__(self, devices, debug=False):
+        self.modules = [EBI(dev, debug=debug, lazy=True) for dev in devices]
+        self.packets = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._idle = queue.Queue()
+        for module in self.modules:
+            self._idle.put(module)
+        self._pool = ThreadPoolExecutor(len(self.modules))
+        self._receivers = []
+        self._running = threading.Event()
+    def close(self):
+        "stop receiving and close all modules"
+        self._running.clear()
+        for thread in self._receivers:
+            thread.join()
+        self._receivers = []
+        self._pool.shutdown()
+        for module in self.modules:
+            module.close()
+    @staticmethod
+    def _configure(module, config):
+        channel = None
+        if 'channel' in config:
+            channel = (
+                config['channel'], config.get('sf', 7), config.get('bw', 0), config.get('cr', 1)
+            )
+        return module.apply_config(
+            power=config.get('power'), channel=channel, policy=config.get('policy'),
+            address=config.get('address'), identifier=config.get('network'), start=True
+        )
+    def configure(self, config):
+        """configure all modules in parallel, each with EBI.apply_config
+
+config is either one dict applied to every module or a list with one
+dict per module; keys: policy, power, channel, sf, bw, cr, address, network.
+Returns the status of the settings written on each module."""
+        if isinstance(config, dict):
+            config = [config] * len(self.modules)
+        return list(self._pool.map(self._configure, self.modules, config))
+    def send_data(self, payload, **kwargs):
+        "send data through the first idle module"
+        module = self._idle.get()
+        try:
+            result = module.send_data(payload, **kwargs)
+        finally:
+            self._idle.put(module)
+        result['module'] = module.dev
+        return result
+    def send_many(self, payloads, **kwargs):
+        "send several payloads concurrently, spread over the idle modules"
+        futures = [self._pool.submit(self.send_data, payload, **kwargs) for payload in payloads]
+        return [future.result() for future in futures]
+    def _receive_loop(self, module, protocol):
+        while self._running.is_set():
+            pkt = module.receive(protocol, timeout=0.5)
+            if pkt is None:
+                continue
+            pkt['module'] = module.dev
+            pkt['timestamp'] = pkt.timestamp
+            # ordered by the time the module's reader got the packet
+            self.packets.put((pkt.timestamp, next(self._order), pkt))
+    def start_receiving(self, protocol=0):
+        "merge packets received by all modules into self.packets, by reception time"
+        if self._running.is_set():
+            return
+        self._running.set()
+        for module in self.modules:
+            thread = threading.Thread(
+                target=self._receive_loop, args=(module, protocol),
+                name=f"gateway-rx {module.dev}", daemon=True
+            )
+            thread.start()
+            self._receivers.append(thread)
+    def receive(self, timeout=None):
+        "get the next packet received by any module"
+        try:
+            return self.packets.get(timeout=timeout)[-1]
+        except queue.Empty:
+            return None
+
+if __name__ == "__main__":
+    DEVICES = sys.argv[1:] or ["/dev/ttyUSB0"]
+    gw = Gateway(DEVICES)
+    # 868.300 MHz, 128 Chips/symbol, 125 kHz, 4/5, always on
+    print("CONFIGURE:", gw.configure({ 'policy': 0, 'channel': 2, 'sf': 7, 'bw': 0, 'cr': 1 }))
+    gw.start_receiving()
+    try:
+        while True:
+            PKT = gw.receive()
+            MSG = '{timestamp:.3f} {module} rssi: {rssi}, src: {src}, dst: {dst}, data:'
+            print(MSG.format(**PKT))
+            print(PKT['data'])
+    except KeyboardInterrupt:
+        gw.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+"""
+Link quality monitoring and spreading factor control.
+
+LinkMonitor keeps the last RSSI values of every peer in fixed size
+array-backed rings; it is a frame tap, fed by packets received from a
+peer (0xE0) and by the acknowledgements of unicast sends to it (0xD0).
+SfController picks the modulation with the least time on air whose
+sensitivity still leaves margin dB below the weakest peer's low RSSI
+percentile.
+
+    m = LinkMonitor()
+    e = EBI(dev, tap=m)
+    c = SfController(e, m, margin=10)
+    c.recommend()      # or c.apply() to switch the module over
+
+Every module of a LoRaEMB network must use the same modulation: apply
+it on all of them, or let the peers follow the same recommendation.
+"""
+
+import sys
+import threading
+import time
+from array import array
+from ebi import EBI
+import lora
+
+class RssiWindow:
+    """Ring of the last size RSSI values, in dBm"""
+    __slots__ = ('values', 'count', '_next')
+    def __init__(self, size=64):
+        self.values = array('h', bytes(2 * size))
+        self.count = 0
+        self._next = 0
+    def __len__(self):
+        return min(self.count, len(self.values))
+    def add(self, rssi):
+        "append a value, overwriting the oldest one once full"
+        self.values[self._next] = rssi
+        self._next = (self._next + 1) % len(self.values)
+        self.count += 1
+    def ordered(self):
+        "values from the oldest to the newest"
+        if self.count < len(self.values):
+            return self.values[:self.count]
+        return self.values[self._next:] + self.values[:self._next]
+    def percentile(self, percent):
+        "nearest-rank percentile, None while empty"
+        if not self.count:
+            return None
+        values = sorted(self.values[:len(self)])
+        return values[min(len(values) - 1, int(percent / 100 * len(values)))]
+    def trend(self):
+        "least-squares slope in dB per sample, None with less than two values"
+        if len(self) < 2:
+            return None
+        values = self.ordered()
+        # least squares over x = 0..n-1, statistics.linear_regression needs 3.10
+        count = len(values)
+        mean_x = (count - 1) / 2
+        mean_y = sum(values) / count
+        covariance = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+        return covariance / sum((x - mean_x) ** 2 for x in range(count))
+
+class LinkMonitor:
+    """Frame tap keeping an RssiWindow per peer address"""
+    def __init__(self, size=64):
+        self.size = size
+        self.links = {}
+        self._lock = threading.Lock()
+        self._pending = {}
+    def observe(self, src, rssi):
+        "account for one RSSI value measured on the link with src"
+        with self._lock:
+            window = self.links.get(src)
+            if window is None:
+                window = self.links[src] = RssiWindow(self.size)
+            window.add(rssi)
+    def __call__(self, direction, port, frame):
+        code = frame[2]
+        if direction == '>':
+            # unicast LoRaEMB send: its acknowledgement measures the link to dst
+            if code == 0x50 and len(frame) >= 8 and frame[3] != 0x09:
+                dst = (frame[5] << 8) + frame[6]
+                self._pending[port] = dst if dst != 0xFFFF else None
+            return
+        if code == 0xE0 and len(frame) >= 12:
+            rssi = (frame[5] << 8) + frame[6]
+            self.observe((frame[7] << 8) + frame[8], rssi - 0x10000 if rssi & 0x8000 else rssi)
+        elif code == 0xD0 and len(frame) >= 8:
+            dst = self._pending.pop(port, None)
+            rssi = (frame[5] << 8) + frame[6]
+            if dst is not None and frame[3] == 0x00 and rssi:
+                self.observe(dst, rssi - 0x10000 if rssi & 0x8000 else rssi)
+    def summary(self, percent=10):
+        "{peer: {'samples', 'percentile', 'median', 'trend'}}"
+        with self._lock:
+            return {
+                src: {
+                    'samples': len(window),
+                    'percentile': window.percentile(percent),
+                    'median': window.percentile(50),
+                    'trend': window.trend(),
+                }
+                for src, window in self.links.items()
+            }
+
+class SfController:
+    """Recommends or applies the fastest modulation the links allow
+
+The weakest peer's percent percentile RSSI must stay margin dB above the
+sensitivity of the modulation. Switching to a faster one also needs
+hysteresis dB more, and at least min_interval seconds since the last
+change; a slower one is chosen as soon as the current one falls short.
+Peers with fewer than min_samples values are left out. length is the
+payload size the time on air is ranked with."""
+    def __init__(self, ebi, monitor, margin=10.0, hysteresis=3.0, percent=10,
+                 min_samples=16, min_interval=600, length=20):
+        self.ebi = ebi
+        self.monitor = monitor
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.percent = percent
+        self.min_samples = min_samples
+        self.min_interval = min_interval
+        self.changes = 0
+        self._changed = None
+        self.modulations = sorted(
+            lora.SENSITIVITY, key=lambda mod: lora.time_on_air(length, *mod)
+        )
+    def weakest(self):
+        "lowest RSSI percentile over the peers with enough samples, None without any"
+        levels = [
+            link['percentile'] for link in self.monitor.summary(self.percent).values()
+            if link['samples'] >= self.min_samples
+        ]
+        return min(levels) if levels else None
+    def recommend(self):
+        """(spreading_factor, bandwidth) to use, None if the current one should stay
+
+Also None while there is not enough data or min_interval has not
+passed since the last change."""
+        rssi = self.weakest()
+        if rssi is None:
+            return None
+        current = self.ebi.operating_channel()
+        current = (current.get('spreading_factor', 7), current.get('bandwidth', 0))
+        if rssi - self.margin < lora.SENSITIVITY.get(current, 0):
+            candidates = self.modulations[self.modulations.index(current) + 1:] \
+                if current in self.modulations else self.modulations
+            extra = 0.0
+        else:
+            if self._changed is not None and time.monotonic() - self._changed < self.min_interval:
+                return None
+            candidates = self.modulations[:self.modulations.index(current)] \
+                if current in self.modulations else []
+            extra = self.hysteresis
+        for modulation in candidates:
+            if rssi - self.margin - extra >= lora.SENSITIVITY[modulation]:
+                return modulation
+        if extra:
+            return None
+        return self.modulations[-1] if current != self.modulations[-1] else None
+    def apply(self):
+        "switch the module to the recommended modulation; returns apply_config's result"
+        modulation = self.recommend()
+        if modulation is None:
+            return {}
+        channel = self.ebi.operating_channel()
+        # apply_config stops the network around the change and starts it again
+        result = self.ebi.apply_config(channel=(
+            channel['channel'], modulation[0], modulation[1], channel.get('coding_rate', 1)
+        ))
+        self.changes += 1
+        self._changed = time.monotonic()
+        return result
+
+if __name__ == "__main__":
+    DEVICE = "/dev/ttyUSB0"
+    if len(sys.argv) > 1:
+        DEVICE = sys.argv[1]
+    m = LinkMonitor()
+    e = EBI(DEVICE, lazy=True, tap=m)
+    print("CONFIG:", e.apply_config(channel=(1,12,0,1), start=True))
+    c = SfController(e, m)
+    while True:
+        print("RECEIVED:", len(e.take(16, timeout=60)))
+        print("LINKS:", m.summary())
+        print("RECOMMENDED (SF, BW):", c.recommend())
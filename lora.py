@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+LoRa modulation helpers, using the EBI parameter codes.
+
+time_on_air follows the Semtech SX1276 datasheet formula; cr is the EBI
+coding rate code, 1 to 4 for 4/5 to 4/8, and bw the EBI bandwidth code.
+"""
+
+import math
+import sys
+
+BANDWIDTH_HZ = {
+    0x00: 125000,
+    0x01: 250000,
+}
+# bytes the LoRaEMB (0) and LoRaWAN (1) framing add to a payload on air
+OVERHEAD = {
+    0: 4,
+    1: 13,
+}
+# largest application payload per spreading factor (EU868 regional limits)
+MAX_PAYLOAD = {
+    7: 222,
+    8: 222,
+    9: 115,
+    10: 51,
+    11: 51,
+    12: 51,
+}
+
+# receiver sensitivity in dBm per (spreading factor, bandwidth), SX1276 datasheet
+SENSITIVITY = {
+    (7, 0x00): -123.0, (7, 0x01): -120.0,
+    (8, 0x00): -126.0, (8, 0x01): -123.0,
+    (9, 0x00): -129.0, (9, 0x01): -126.0,
+    (10, 0x00): -132.0, (10, 0x01): -129.0,
+    (11, 0x00): -134.5, (11, 0x01): -131.5,
+    (12, 0x00): -137.0, (12, 0x01): -134.0,
+}
+
+def symbol_time(spreading_factor, bandwidth=0x00):
+    "duration of one symbol, in seconds"
+    return (1 << spreading_factor) / BANDWIDTH_HZ[bandwidth]
+
+def time_on_air(
+    length, spreading_factor, bandwidth=0x00, coding_rate=0x01,
+    preamble=8, explicit_header=True, crc=True
+):
+    "time on air of a packet carrying length bytes, in seconds"
+    tsym = symbol_time(spreading_factor, bandwidth)
+    low_data_rate = tsym > 0.016
+    payload_bits = 8 * length - 4 * spreading_factor + 28 + 16 * crc - 20 * (not explicit_header)
+    payload_symbols = 8 + max(
+        math.ceil(payload_bits / (4 * (spreading_factor - 2 * low_data_rate))) * (coding_rate + 4),
+        0
+    )
+    return (preamble + 4.25 + payload_symbols) * tsym
+
+def max_payload(spreading_factor):
+    "largest payload that fits one frame at the given spreading factor"
+    return MAX_PAYLOAD[spreading_factor]
+
+if __name__ == "__main__":
+    LENGTH = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for SF in sorted(MAX_PAYLOAD):
+        for BW in sorted(BANDWIDTH_HZ):
+            TOA = time_on_air(LENGTH, SF, BW)
+            KHZ = BANDWIDTH_HZ[BW] // 1000
+            print(f"SF{SF:<2d} {KHZ} kHz {LENGTH:3d} bytes: {TOA * 1000:8.1f} ms")
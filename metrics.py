@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+"""
+Link metrics for EBI, collected as a frame tap.
+
+    m = Metrics()
+    e = EBI(dev, tap=m)            # or tap=tee(m, CaptureWriter(path))
+    print(m.prometheus())
+"""
+
+import bisect
+import collections
+import threading
+import time
+from ebi import EBI
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+# commands whose response carries a status rather than a value
+STATUS_ONLY = (0x05, 0x30, 0x31, 0x50)
+
+class Histogram:
+    """Cumulative histogram over fixed buckets"""
+    __slots__ = ('counts', 'sum', 'count')
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        "account for one value"
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Summary:
+    """count, sum, min and max of a series"""
+    __slots__ = ('count', 'sum', 'min', 'max')
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+    def observe(self, value):
+        "account for one value"
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+    def mean(self):
+        "average value, None before the first one"
+        return self.sum / self.count if self.count else None
+
+class Metrics:
+    """Frame tap collecting per-port link metrics
+
+Round trips are timed from the command leaving to its response coming
+back; setter and send_data responses are counted by EBI.STATUS. With a
+callback, snapshot() is handed to it at most once every interval
+seconds, from whichever thread passes frames through the tap."""
+    def __init__(self, callback=None, interval=60):
+        self.callback = callback
+        self.interval = interval
+        self.latency = collections.defaultdict(Histogram)
+        self.status = collections.Counter()
+        self.bytes = collections.Counter()
+        self.frames = collections.Counter()
+        self.rx_packets = collections.Counter()
+        self.rx_rssi = collections.defaultdict(Summary)
+        self.tx_rssi = collections.defaultdict(Summary)
+        self.tx_retries = collections.Counter()
+        self.waiting_time = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_export = time.monotonic()
+        self._last_rx = (self._last_export, collections.Counter())
+    def __call__(self, direction, port, frame):
+        now = time.monotonic()
+        with self._lock:
+            self.bytes[port, direction] += len(frame)
+            self.frames[port, direction] += 1
+            code = frame[2]
+            if direction == '>':
+                setter = code in STATUS_ONLY or len(frame) > (5 if code == 0x7E else 4)
+                self._pending[port, code | 0x80] = (now, setter)
+            elif code == 0xE0:
+                self.rx_packets[port] += 1
+                if len(frame) >= 12:
+                    rssi = (frame[5] << 8) + frame[6]
+                    src = (frame[7] << 8) + frame[8]
+                    self.rx_rssi[port, src].observe(rssi - 0x10000 if rssi & 0x8000 else rssi)
+            else:
+                self._response(port, code, frame, now)
+        if self.callback and now - self._last_export >= self.interval:
+            self._last_export = now
+            self.callback(self.snapshot())
+    def _response(self, port, code, frame, now):
+        pending = self._pending.pop((port, code), None)
+        if pending is None:
+            return
+        sent, setter = pending
+        self.latency[port, code & 0x7F].observe(now - sent)
+        if setter and len(frame) >= 5:
+            self.status[port, code & 0x7F, EBI.STATUS.get(frame[3], frame[3])] += 1
+        if code == 0xD0 and len(frame) >= 8:
+            self.tx_retries[port] += frame[4]
+            rssi = (frame[5] << 8) + frame[6]
+            self.tx_rssi[port].observe(rssi - 0x10000 if rssi & 0x8000 else rssi)
+            if len(frame) == 16:
+                self.waiting_time[port] = int.from_bytes(frame[11:15], 'big')
+    def _rx_rate(self):
+        "received packets per second and port since the previous call"
+        now = time.monotonic()
+        since, before = self._last_rx
+        self._last_rx = (now, collections.Counter(self.rx_packets))
+        elapsed = max(now - since, 1e-9)
+        return { port: (count - before[port]) / elapsed for port, count in self.rx_packets.items() }
+    def snapshot(self):
+        "plain dict copy of all metrics, plus the RX packet rate since the last export"
+        with self._lock:
+            return {
+                'latency': {
+                    key: { 'buckets': list(zip(LATENCY_BUCKETS + (float('inf'),), hist.counts)),
+                           'sum': hist.sum, 'count': hist.count }
+                    for key, hist in self.latency.items()
+                },
+                'status': dict(self.status),
+                'bytes': dict(self.bytes),
+                'frames': dict(self.frames),
+                'rx_packets': dict(self.rx_packets),
+                'rx_rate': self._rx_rate(),
+                'rx_rssi': {
+                    key: { 'count': s.count, 'min': s.min, 'max': s.max, 'mean': s.mean() }
+                    for key, s in self.rx_rssi.items()
+                },
+                'tx_rssi': {
+                    key: { 'count': s.count, 'min': s.min, 'max': s.max, 'mean': s.mean() }
+                    for key, s in self.tx_rssi.items()
+                },
+                'tx_retries': dict(self.tx_retries),
+                'waiting_time': dict(self.waiting_time),
+            }
+    def prometheus(self):
+        "metrics in Prometheus text exposition format; the RX rate is since the last export"
+        lines = []
+        def family(name, kind):
+            lines.append(f"# TYPE {name} {kind}")
+        def sample(name, labels, value):
+            text = ','.join(f'{key}="{val}"' for key, val in labels)
+            lines.append(f"{name}{{{text}}} {value}")
+        with self._lock:
+            family('ebi_command_latency_seconds', 'histogram')
+            for (port, code), hist in sorted(self.latency.items()):
+                labels = (('port', port), ('command', f"{code:#04x}"))
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += count
+                    sample('ebi_command_latency_seconds_bucket',
+                           labels + (('le', bound),), cumulative)
+                sample('ebi_command_latency_seconds_sum', labels, hist.sum)
+                sample('ebi_command_latency_seconds_count', labels, hist.count)
+            family('ebi_status_total', 'counter')
+            for (port, code, status), count in sorted(self.status.items(), key=str):
+                sample('ebi_status_total', (
+                    ('port', port), ('command', f"{code:#04x}"), ('status', status)
+                ), count)
+            for name, counter in (('ebi_bytes_total', self.bytes),
+                                  ('ebi_frames_total', self.frames)):
+                family(name, 'counter')
+                for (port, direction), count in sorted(counter.items()):
+                    direction = 'out' if direction == '>' else 'in'
+                    sample(name, (('port', port), ('direction', direction)), count)
+            family('ebi_rx_packets_per_second', 'gauge')
+            for port, rate in sorted(self._rx_rate().items()):
+                sample('ebi_rx_packets_per_second', (('port', port),), rate)
+            family('ebi_rx_packets_total', 'counter')
+            for (port, src), summary in sorted(self.rx_rssi.items()):
+                labels = (('port', port), ('src', f"{src:04x}"))
+                sample('ebi_rx_packets_total', labels, summary.count)
+            family('ebi_rx_rssi_dbm', 'gauge')
+            for (port, src), summary in sorted(self.rx_rssi.items()):
+                labels = (('port', port), ('src', f"{src:04x}"))
+                for stat, value in (('min', summary.min), ('max', summary.max),
+                                    ('mean', summary.mean())):
+                    sample('ebi_rx_rssi_dbm', labels + (('stat', stat),), value)
+            family('ebi_tx_rssi_dbm', 'gauge')
+            for port, summary in sorted(self.tx_rssi.items()):
+                for stat, value in (('min', summary.min), ('max', summary.max),
+                                    ('mean', summary.mean())):
+                    sample('ebi_tx_rssi_dbm', (('port', port), ('stat', stat)), value)
+            family('ebi_tx_retries_total', 'counter')
+            for port, count in sorted(self.tx_retries.items()):
+                sample('ebi_tx_retries_total', (('port', port),), count)
+            family('ebi_tx_waiting_time', 'gauge')
+            for port, value in sorted(self.waiting_time.items()):
+                sample('ebi_tx_waiting_time', (('port', port),), value)
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+"""
+Serial port multiplexer: one process owns the module, many use it.
+
+MuxServer holds the EBI connection and serves local clients over a Unix
+socket. Clients write EBI request frames to the socket as they would to
+the port; requests go to the module one at a time and each answer goes
+back to the client that asked. Other notifications (boot, ...) are sent
+to every client. Received packets (0xE0) do not go through the socket:
+they are published in an RxRing, fixed size slots in a shared memory
+file that any number of processes map and read in place.
+
+    mux.py /dev/ttyUSB0 /run/ebi.sock            # the daemon
+    e = MuxClient('/run/ebi.sock')                # used as an EBI
+    embitshell.py /run/ebi.sock                   # attach a shell
+
+The server first sends a line with GREETING and the path of the ring,
+then frames flow both ways.
+"""
+
+import mmap
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from ebi import EBI, EBIError, FrameDecoder, FrameEncoder
+
+GREETING = b'EBIMUX1'
+RING_MAGIC = b'EBIRING1'
+RING_HEADER = struct.Struct('<8sIIQ')
+HEAD = struct.Struct('<Q')
+HEAD_OFFSET = 16
+SLOT_HEADER = struct.Struct('<QH')
+SLOT_SIZE = 0x210
+
+def is_socket(path):
+    "True if path is a Unix socket, a MuxServer's presumably"
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+class RxRing:
+    """Ring of frames in a shared memory file, written by one process
+
+Each slot holds a sequence number, a length and a frame. The writer
+clears the sequence number while it rewrites a slot and moves head, the
+number of the last frame, once done: a reader finding the number it
+expects knows the slot holds that frame. Readers map the file read-only."""
+    def __init__(self, path, writable=False):
+        self.path = path
+        with open(path, 'r+b' if writable else 'rb') as file:
+            self.map = mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            )
+        magic, self.slots, self.slot_size, _ = RING_HEADER.unpack_from(self.map)
+        if magic != RING_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a frame ring")
+        self.view = memoryview(self.map)
+    @classmethod
+    def create(cls, path, slots=1024, slot_size=SLOT_SIZE):
+        "create an empty ring file and open it for writing"
+        with open(path, 'wb') as file:
+            file.write(RING_HEADER.pack(RING_MAGIC, slots, slot_size, 0))
+            file.truncate(RING_HEADER.size + slots * slot_size)
+        return cls(path, writable=True)
+    def close(self):
+        "unmap the file; views handed out must be released first"
+        self.view.release()
+        self.map.close()
+    @property
+    def head(self):
+        "sequence number of the last frame written, 0 before the first one"
+        return HEAD.unpack_from(self.map, HEAD_OFFSET)[0]
+    def offset(self, seq):
+        "offset of the slot of frame seq"
+        return RING_HEADER.size + seq % self.slots * self.slot_size
+    def publish(self, frame):
+        "write frame to the next slot, cut to the slot size"
+        seq = self.head + 1
+        offset = self.offset(seq)
+        length = min(len(frame), self.slot_size - SLOT_HEADER.size)
+        SLOT_HEADER.pack_into(self.map, offset, 0, length)
+        start = offset + SLOT_HEADER.size
+        self.map[start:start + length] = frame[:length]
+        HEAD.pack_into(self.map, offset, seq)
+        HEAD.pack_into(self.map, HEAD_OFFSET, seq)
+        return seq
+
+class RingReader:
+    """Reads the frames published in an RxRing from when it is opened on
+
+get() returns a memoryview of the frame in the shared memory: nothing is
+copied, and the view stays good until the writer comes round to its slot
+again, slots frames later; intact(seq) tells whether it still is. Frames
+overwritten before they were read are counted in lost. The ring is
+polled every poll seconds while empty."""
+    def __init__(self, path, poll=0.002):
+        self.ring = RxRing(path)
+        self.poll = poll
+        self.next = self.ring.head + 1
+        self.lost = 0
+    def close(self):
+        "unmap the ring"
+        self.ring.close()
+    def get(self, timeout=None):
+        "(seq, view) of the next frame, None if nothing arrives within timeout"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ring = self.ring
+        while True:
+            head = ring.head
+            if head >= self.next:
+                if head - self.next >= ring.slots:
+                    self.lost += head - ring.slots + 1 - self.next
+                    self.next = head - ring.slots + 1
+                offset = ring.offset(self.next)
+                seq, length = SLOT_HEADER.unpack_from(ring.map, offset)
+                if seq == self.next:
+                    self.next += 1
+                    start = offset + SLOT_HEADER.size
+                    return seq, ring.view[start:start + length]
+                continue # overwritten meanwhile: catch up with head
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll)
+    def intact(self, seq):
+        "True if the frame seq has not been overwritten"
+        return HEAD.unpack_from(self.ring.map, self.ring.offset(seq))[0] == seq
+
+class MuxServer:
+    """Serves the module of ebi to the clients of a Unix socket at path
+
+Requests are sent under the EBI lock, so a client's exchange is never
+interleaved with another's; a request the module does not answer gets
+no answer, and the client times out. The ring file, next to the other
+shared memory files by default, is removed at close."""
+    def __init__(self, ebi, path, ring_path=None, slots=1024):
+        self.ebi = ebi
+        self.path = path
+        if ring_path is None:
+            shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            ring_path = os.path.join(shm, f"ebimux-{os.getpid()}-{os.path.basename(path)}")
+        self.ring_path = ring_path
+        self.ring = RxRing.create(ring_path, slots)
+        self.requests = 0
+        self.clients = {}
+        self._lock = threading.Lock()
+        if is_socket(path): # left over by a previous run
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self._running = threading.Event()
+        self._running.set()
+        self._threads = [
+            threading.Thread(target=target, name=f"mux {name} {path}", daemon=True)
+            for name, target in (
+                ('accept', self._accept_loop), ('rx', self._rx_loop),
+                ('notifications', self._notification_loop),
+            )
+        ]
+        for thread in self._threads:
+            thread.start()
+    def close(self):
+        "disconnect the clients, remove the socket and the ring"
+        if not self._running.is_set():
+            return
+        self._running.clear()
+        for sock in [self.sock] + list(self.clients):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+        for thread in self._threads:
+            thread.join()
+        os.unlink(self.path)
+        self.ring.close()
+        os.unlink(self.ring_path)
+    def _accept_loop(self):
+        while self._running.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            conn.sendall(GREETING + b' ' + self.ring_path.encode() + b'\n')
+            with self._lock:
+                self.clients[conn] = threading.Lock()
+            threading.Thread(
+                target=self._serve, args=(conn,), name=f"mux client {self.path}", daemon=True
+            ).start()
+    def _write(self, conn, frame):
+        with self._lock:
+            lock = self.clients.get(conn)
+        if lock is None:
+            return
+        with lock:
+            try:
+                conn.sendall(frame)
+            except OSError:
+                pass # gone, its thread cleans up
+    def _serve(self, conn):
+        "client thread: forward its requests in turn and answer it alone"
+        decoder = FrameDecoder()
+        encoder = FrameEncoder(0x400)
+        try:
+            while self._running.is_set():
+                data = conn.recv(4096)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    body = frame[2:-1]
+                    try:
+                        ans = self.ebi._send(body[:1], body[1:]) # pylint: disable=protected-access
+                    except EBIError:
+                        continue
+                    self.requests += 1
+                    self._write(conn, bytes(encoder.encode([body[0] | 0x80], ans)))
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                del self.clients[conn]
+            conn.close()
+    def _rx_loop(self):
+        while self._running.is_set():
+            got = self.ebi.rx.get(0.2)
+            if got is not None:
+                self.ring.publish(got[1])
+    def _notification_loop(self):
+        encoder = FrameEncoder(0x400)
+        while self._running.is_set():
+            frame = self.ebi.notifications.get(0.2)
+            if frame is None:
+                continue
+            packet = bytes(encoder.encode(frame))
+            with self._lock:
+                clients = list(self.clients)
+            for conn in clients:
+                self._write(conn, packet)
+
+class SocketPort:
+    """The client socket, looking like the serial port to EBI's reader thread"""
+    in_waiting = 4096 # recv returns what has arrived, up to that
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(0.2)
+    def read(self, size):
+        "what arrived, up to size bytes; b'' after 0.2 s of silence"
+        try:
+            data = self.sock.recv(size)
+        except socket.timeout:
+            return b''
+        if not data:
+            raise ConnectionResetError("multiplexer closed the connection")
+        return data
+    def write(self, data):
+        "send data"
+        self.sock.sendall(data)
+    def cancel_read(self):
+        "wake the reader thread up"
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    def close(self):
+        "close the socket"
+        self.sock.close()
+
+class MuxClient(EBI):
+    """EBI talking to a MuxServer instead of the port
+
+Takes EBI's arguments, the socket path instead of the port. Received
+packets are read from the server's ring; dropped also counts those
+overwritten there before they were read. The configuration cache is
+the client's own: settings written by another client are only seen with
+refresh=True, or once the module rebooted."""
+    def __init__(self, path, **kwargs):
+        self._ring = None
+        self._ring_thread = None
+        super().__init__(path, **kwargs)
+        self._ring_thread = threading.Thread(
+            target=MuxClient._ring_loop, args=(weakref.ref(self), self._ring, self._running),
+            name=f"ebi-ring {path}", daemon=True
+        )
+        self._ring_thread.start()
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.dev)
+        greeting = b''
+        while not greeting.endswith(b'\n'):
+            byte = sock.recv(1)
+            if not byte:
+                raise EBIError(f"{self.dev}: no greeting from the multiplexer")
+            greeting += byte
+        magic, _, ring_path = greeting[:-1].partition(b' ')
+        if magic != GREETING:
+            raise EBIError(f"{self.dev}: not a multiplexer")
+        self._ring = RingReader(ring_path.decode())
+        return SocketPort(sock)
+    @staticmethod
+    def _ring_loop(ref, reader, running):
+        # as EBI's reader, only reference the client to hand it a frame
+        while running.is_set():
+            got = reader.get(0.2)
+            if got is None:
+                continue
+            seq, view = got
+            frame = bytes(view)
+            view.release()
+            if not reader.intact(seq):
+                reader.lost += 1
+                continue
+            ebi = ref()
+            if ebi is None:
+                return
+            ebi._dispatch(frame) # pylint: disable=protected-access
+            del ebi
+    def close(self):
+        "detach from the multiplexer"
+        super().close()
+        if self._ring_thread is not None and self._ring_thread is not threading.current_thread():
+            self._ring_thread.join()
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+    @property
+    def dropped(self):
+        "frames lost to a full receive or notification buffer, or overwritten in the ring"
+        return super().dropped + (self._ring.lost if self._ring else 0)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"Usage: {sys.argv[0]} device socket")
+        sys.exit(1)
+    e = EBI(sys.argv[1], lazy=True)
+    SERVER = MuxServer(e, sys.argv[2])
+    print(f"serving {sys.argv[1]} on {sys.argv[2]}, packets in {SERVER.ring_path}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"{len(SERVER.clients)} clients, {SERVER.requests} requests, "
+                  f"{SERVER.ring.head} packets")
+    except KeyboardInterrupt:
+        pass
+    SERVER.close()
+    e.close()
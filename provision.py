@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Fleet provisioning: bring many modules to a spec, in parallel.
+
+The spec is a JSON file with settings shared by every module and the
+ones of each device; device entries override the defaults:
+
+    {
+        "defaults": { "channel": [1, 7, 0, 1], "power": 14, "policy": 0,
+                      "identifier": "00:01" },
+        "devices": [
+            { "port": "/dev/ttyUSB0", "address": "00:05",
+              "ieee": "00:11:22:33:44:55:66:77" },
+            ...
+        ]
+    }
+
+Settings are those of EBI.apply_config: power, channel, policy,
+address, identifier, preference and ieee; byte strings are written as
+"00:05" or as lists of ints. Each module is only written the settings it
+does not hold yet, then read back to verify them. The report has one
+entry per device:
+
+    provision.py fleet.json [--workers N] [--report report.json]
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ebi import EBI
+
+SETTINGS = ('power', 'channel', 'policy', 'address', 'identifier', 'preference', 'ieee')
+
+def parse_value(value):
+    "spec value as apply_config takes it: '00:05' becomes [0x00, 0x05]"
+    if isinstance(value, str):
+        return [int(part, 16) for part in value.replace('-', ':').split(':')]
+    return value
+
+def device_config(spec, device):
+    "apply_config keyword arguments of one device of spec"
+    config = dict(spec.get('defaults', {}))
+    config.update(device)
+    unknown = set(config) - set(SETTINGS) - {'port', 'start'}
+    if unknown:
+        raise ValueError(f"{device.get('port')}: unknown settings {', '.join(sorted(unknown))}")
+    return { key: parse_value(config[key]) for key in SETTINGS if key in config }
+
+def provision(port, config, start=True, debug=False):
+    "apply config to the module on port and verify it; returns the device report"
+    report = { 'port': port, 'written': {}, 'mismatches': [], 'error': None }
+    begin = time.monotonic()
+    ebi = None
+    try:
+        ebi = EBI(port, debug=debug, lazy=True)
+        report['uuid'] = ebi.identity()['uuid']
+        report['written'] = ebi.apply_config(start=start, **config)
+        report['mismatches'] = ebi.verify_config(**config)
+    except Exception as exc: # pylint: disable=broad-except
+        report['error'] = f"{type(exc).__name__}: {exc}"
+    finally:
+        if ebi is not None:
+            ebi.close()
+    report['ok'] = report['error'] is None and not report['mismatches'] and \
+        all(status == 'Success' for status in report['written'].values())
+    report['seconds'] = round(time.monotonic() - begin, 3)
+    return report
+
+def provision_fleet(spec, workers=32, debug=False):
+    "provision every device of spec concurrently; returns the reports in spec order"
+    devices = spec['devices']
+    configs = [device_config(spec, device) for device in devices]
+    default_start = spec.get('defaults', {}).get('start', True)
+    starts = [device.get('start', default_start) for device in devices]
+    with ThreadPoolExecutor(max(1, min(workers, len(devices)))) as pool:
+        return list(pool.map(
+            lambda args: provision(*args, debug=debug),
+            zip([device['port'] for device in devices], configs, starts)
+        ))
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    PARSER.add_argument('spec', help="fleet spec, JSON")
+    PARSER.add_argument('--workers', type=int, default=32, help="ports driven at once")
+    PARSER.add_argument('--report', metavar='FILE', help="save the reports as JSON")
+    PARSER.add_argument('--debug', action='store_true', help="print every frame")
+    ARGS = PARSER.parse_args()
+    with open(ARGS.spec, encoding='utf8') as spec_file:
+        SPEC = json.load(spec_file)
+    BEGIN = time.monotonic()
+    REPORTS = provision_fleet(SPEC, ARGS.workers, ARGS.debug)
+    for REPORT in REPORTS:
+        STATUS = 'ok' if REPORT['ok'] else 'FAILED'
+        DETAIL = REPORT['error'] or ', '.join(REPORT['mismatches']) or \
+            ', '.join(REPORT['written']) or 'unchanged'
+        print(f"{REPORT['port']:20s} {STATUS:6s} {REPORT['seconds']:6.2f} s  {DETAIL}")
+    print(f"{sum(r['ok'] for r in REPORTS)}/{len(REPORTS)} provisioned "
+          f"in {time.monotonic() - BEGIN:.2f} s")
+    if ARGS.report:
+        with open(ARGS.report, 'w', encoding='utf8') as report_file:
+            json.dump(REPORTS, report_file, indent=2)
+    sys.exit(0 if all(r['ok'] for r in REPORTS) else 1)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+"""
+Duty-cycle aware pacing of send_data.
+
+On the 868 MHz band every transmission of t seconds on air closes its
+sub-band for t * (1 / duty_cycle - 1) seconds afterwards. TxScheduler
+keeps that budget per sub-band, takes the time on air from the current
+operating_channel and honours the waiting_time the module reports, so
+queued payloads go out as fast as allowed without being refused.
+
+    s = TxScheduler(e)
+    s.send(payload)                # blocks until the band is free
+    future = s.submit(payload)     # or queue it, sent in order
+    s.next_tx_time(len(payload))   # when the next one could leave
+"""
+
+import collections
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from ebi import EBI
+import lora
+
+# EBI.LORA_CHANNEL codes to the regulatory sub-band they fall in
+SUB_BAND = {
+    0x01: '868.0-868.6 MHz',
+    0x02: '868.0-868.6 MHz',
+    0x03: '868.0-868.6 MHz',
+    0x04: '869.4-869.65 MHz',
+}
+DUTY_CYCLE = {
+    '868.0-868.6 MHz': 0.01,
+    '869.4-869.65 MHz': 0.1,
+}
+# send_data statuses meaning "not now" rather than "never"
+RETRY_STATUS = (0x06, 0x07)
+
+class TxScheduler:
+    """Paces send_data on one module to the duty-cycle budget
+
+duty_cycle overrides the DUTY_CYCLE share of a sub-band. waiting_time
+values reported by the module are read in waiting_time_unit seconds.
+A send refused as Busy or Cannot send is retried up to retries times,
+after the reported waiting time or one more time on air."""
+    def __init__(self, ebi, duty_cycle=None, waiting_time_unit=0.001, retries=3):
+        self.ebi = ebi
+        self.duty_cycle = dict(DUTY_CYCLE, **(duty_cycle or {}))
+        self.waiting_time_unit = waiting_time_unit
+        self.retries = retries
+        self.sent = 0
+        self.rejected = 0
+        self.airtime = collections.Counter()
+        self._available = {}
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._closed = False
+    def close(self):
+        "stop the queue worker once the queued payloads are sent"
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._worker:
+            self._worker.join()
+    def sub_band(self):
+        "sub-band of the current operating channel"
+        return SUB_BAND.get(self.ebi.operating_channel()['channel'], '868.0-868.6 MHz')
+    def time_on_air(self, length, protocol=0):
+        "seconds on air of a payload of length bytes with the current modulation"
+        channel = self.ebi.operating_channel()
+        return lora.time_on_air(
+            length + lora.OVERHEAD[protocol], channel.get('spreading_factor', 7),
+            channel.get('bandwidth', 0), channel.get('coding_rate', 1)
+        )
+    def next_tx_time(self, length=None, protocol=0):
+        """time.monotonic() at which the next payload could go out
+
+With length, a payload of that size must also fit the budget left on
+the band after the queued ones."""
+        with self._lock:
+            start = max(self._available.get(self.sub_band(), 0.0), self._blocked_until)
+        if length is None:
+            return max(start, time.monotonic())
+        with self._cond:
+            queued = [
+                (len(payload), kwargs.get('protocol', 0)) for payload, kwargs, _ in self._queue
+            ]
+        start = max(start, time.monotonic())
+        off = 1 / self.duty_cycle[self.sub_band()]
+        for size, proto in queued:
+            start += self.time_on_air(size, proto) * off
+        return start
+    def _wait(self):
+        band = self.sub_band()
+        with self._lock:
+            delay = max(self._available.get(band, 0.0), self._blocked_until) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return band
+    def _account(self, band, toa, result):
+        now = time.monotonic()
+        with self._lock:
+            if result.ok:
+                self.sent += 1
+                self.airtime[band] += toa
+                self._available[band] = now + toa * (1 / self.duty_cycle[band] - 1)
+            else:
+                self.rejected += 1
+            if result.waiting_time:
+                self._blocked_until = now + result.waiting_time * self.waiting_time_unit
+            elif not result.ok:
+                self._blocked_until = now + toa
+    def send(self, payload, **kwargs):
+        "send_data once the band allows it; returns the TxResult"
+        toa = self.time_on_air(len(payload), kwargs.get('protocol', 0))
+        for _ in range(self.retries + 1):
+            band = self._wait()
+            result = self.ebi.send_data(payload, **kwargs)
+            self._account(band, toa, result)
+            if result.status_code not in RETRY_STATUS:
+                break
+        return result
+    def submit(self, payload, **kwargs):
+        "queue a payload for sending in order; returns a Future of its TxResult"
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("scheduler closed")
+            self._queue.append((payload, kwargs, future))
+            self._cond.notify()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="tx scheduler", daemon=True)
+                self._worker.start()
+        return future
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                payload, kwargs, future = self._queue[0]
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.send(payload, **kwargs))
+                except Exception as exc: # pylint: disable=broad-except
+                    future.set_exception(exc)
+            with self._cond:
+                self._queue.popleft()
+
+if __name__ == "__main__":
+    DEVICE = "/dev/ttyUSB0"
+    if len(sys.argv) > 1:
+        DEVICE = sys.argv[1]
+    e = EBI(DEVICE, lazy=True)
+    print("CONFIG:", e.apply_config(policy=0x02, channel=(2,7,0,1), start=True))
+    s = TxScheduler(e)
+    PAYLOAD = list(range(20))
+    print(f"time on air {s.time_on_air(len(PAYLOAD)) * 1000:.1f} ms in {s.sub_band()}")
+    for _ in range(5):
+        print(f"next TX in {s.next_tx_time(len(PAYLOAD)) - time.monotonic():.2f} s:",
+              s.send(PAYLOAD))
+    e.close()
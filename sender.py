@@ -4,26 +4,23 @@
 import sys
 import time
 from ebi import EBI
+from scheduler import TxScheduler
 
 if __name__ == "__main__":
     DEVICE = "/dev/ttyUSB0"
     if len(sys.argv) > 1:
         DEVICE = sys.argv[1]
-    e = EBI(DEVICE, debug=True)
+    e = EBI(DEVICE, debug=True, lazy=True)
     print("RESET:", e.reset())
     print("STATE:", e.state)
-    if e.state['state'] == 'Online':
-        print("NETWORK STOP:", e.network_stop())
-    print("ENERGY SAVE -> TX ONLY:", e.energy_save(0x02))
-    print("OUTPUT POWER -> +13dBm:", e.output_power(13))
     print(
-        "OPERATING CHANNEL -> CH 2 (868.300 MHz), SF 7, BW 125 kHz, CR 4/5:",
-        e.operating_channel(2,7,0,1)
+        "CONFIG -> TX ONLY, +13dBm, CH 2 (868.300 MHz), SF 7, BW 125 kHz, CR 4/5:",
+        e.apply_config(policy=0x02, power=13, channel=(2,7,0,1), start=True)
     )
-    print("NETWORK START:", e.network_start())
     payload = [0x12, 0x12, 0x12] + list(range(1,21))
+    scheduler = TxScheduler(e)
     while True:
-        p, r = e.hex(payload), e.send_data(payload=payload)
-        print(f"SEND DATA:\n\tpayload: {p}\n\tresult: {r}")
-        time.sleep(1)
+        p, r = e.hex(payload), scheduler.send(payload)
+        wait = scheduler.next_tx_time(len(payload)) - time.monotonic()
+        print(f"SEND DATA:\n\tpayload: {p}\n\tresult: {r}\n\tnext in: {wait:.1f} s")
     print("NETWORK STOP:", e.network_stop())
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+"""
+Append-only store of received packets.
+
+Packets go to segment files in one directory, each named after the
+time of its first packet in microseconds:
+
+    <start>.dat   MAGIC, then one RECORD and the payload per packet
+    <start>.tix   one TIME_ENTRY (timestamp, offset) per BLOCK packets
+    <start>.six   written when the segment is closed: a count, one
+                  SOURCE_ENTRY (src, first, count) per source, then
+                  the record offsets of every source, in that order
+
+Queries memory-map the files. Without a source they read the blocks the
+time index points at; with one they bisect the offsets of that source's
+records by time and read just those (the open segment keeps its source
+offsets in memory). Timestamps never go backwards within a store, across
+restarts included: a packet stamped before the previous one takes its
+time, and a segment never takes the name of an existing one.
+
+    s = PacketStore('/var/lib/ebi/packets')
+    s.follow(e)                                  # store everything e receives
+    s.query(src=0x0005, start=time.time() - 3600)
+"""
+
+import collections
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+MAGIC = b'EBIPKT1\n'
+RECORD = struct.Struct('<qHHhHBH')
+TIME_ENTRY = struct.Struct('<qq')
+SOURCE_COUNT = struct.Struct('<I')
+SOURCE_ENTRY = struct.Struct('<HxxII')
+STAMP = struct.Struct('<q')
+BLOCK = 256
+
+StoredPacket = collections.namedtuple(
+    'StoredPacket', ('timestamp', 'src', 'dst', 'rssi', 'options', 'protocol', 'data')
+)
+StoredPacket.__doc__ = "stored packet; dst holds the port of LoRaWAN (protocol 1) packets"
+
+class Stamps:
+    """Timestamps of the records at offsets, as a sequence bisect can search"""
+    __slots__ = ('data', 'offsets')
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+    def __len__(self):
+        return len(self.offsets)
+    def __getitem__(self, position):
+        return STAMP.unpack_from(self.data, self.offsets[position])[0]
+
+class Segment:
+    """One segment: data file and its two sparse indexes"""
+    def __init__(self, directory, start):
+        self.start = start
+        self.base = os.path.join(directory, f"{start:016d}")
+        self.end = None
+        self.sources = None
+    def paths(self):
+        "data, time index and source index file names"
+        return (f"{self.base}.dat", f"{self.base}.tix", f"{self.base}.six")
+    def size(self):
+        "bytes used on disk"
+        return sum(os.path.getsize(path) for path in self.paths() if os.path.exists(path))
+    def remove(self):
+        "delete the segment files"
+        for path in self.paths():
+            if os.path.exists(path):
+                os.remove(path)
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    def write_sources(self, sources):
+        "write the source index out of {src: array of record offsets}"
+        with open(self.paths()[2], 'wb') as file:
+            file.write(SOURCE_COUNT.pack(len(sources)))
+            first = 0
+            for src in sorted(sources):
+                file.write(SOURCE_ENTRY.pack(src, first, len(sources[src])))
+                first += len(sources[src])
+            for src in sorted(sources):
+                sources[src].tofile(file)
+    def last_stamp(self):
+        "timestamp of the last packet stored, the start if there is none"
+        data_path, time_path, _ = self.paths()
+        try:
+            data = self._map(data_path)
+            index = self._map(time_path)
+        except FileNotFoundError:
+            return self.start
+        stamp = self.start
+        count = len(index) // TIME_ENTRY.size
+        offset = len(MAGIC)
+        if count:
+            offset = TIME_ENTRY.unpack_from(index, (count - 1) * TIME_ENTRY.size)[1]
+        # walk the last block, stopping at a record cut short by a crash
+        while offset + RECORD.size <= len(data):
+            fields = RECORD.unpack_from(data, offset)
+            offset += RECORD.size + fields[6]
+            if offset > len(data):
+                break
+            stamp = max(stamp, fields[0])
+        return stamp
+    def _source_offsets(self, src):
+        if self.sources is not None: # still being written
+            return array('I', self.sources.get(src, ()))
+        try:
+            index = self._map(self.paths()[2])
+        except FileNotFoundError: # segment left open by a crash: scan it
+            return None
+        if not index:
+            return None
+        count, = SOURCE_COUNT.unpack_from(index)
+        table = SOURCE_COUNT.size
+        srcs = [SOURCE_ENTRY.unpack_from(index, table + i * SOURCE_ENTRY.size)[0]
+                for i in range(count)]
+        position = bisect_left(srcs, src)
+        if position == count or srcs[position] != src:
+            return ()
+        _, first, length = SOURCE_ENTRY.unpack_from(index, table + position * SOURCE_ENTRY.size)
+        offsets = table + count * SOURCE_ENTRY.size
+        return memoryview(index)[offsets:offsets + (first + length) * 4].cast('I')[first:]
+    def query(self, start, end, src):
+        "iterate over the packets of the segment from start to end (microseconds) and src"
+        data_path, time_path, _ = self.paths()
+        try:
+            data = self._map(data_path)
+            index = self._map(time_path)
+        except FileNotFoundError: # expired meanwhile
+            return
+        if not data or not index:
+            return
+        unpack, size = RECORD.unpack_from, RECORD.size
+        def packet(offset):
+            stamp, source, dst, rssi, options, protocol, length = unpack(data, offset)
+            return StoredPacket(stamp / 1e6, source, dst, rssi, options, protocol,
+                                bytes(data[offset + size:offset + size + length]))
+        records = None if src is None else self._source_offsets(src)
+        if records is not None:
+            # skip records appended after data was mapped
+            records = records[:bisect_left(records, len(data) - size + 1)]
+            stamps = Stamps(data, records)
+            first = bisect_left(stamps, start)
+            last = bisect_right(stamps, end)
+            for position in range(first, last):
+                yield packet(records[position])
+            return
+        times = memoryview(index)[:len(index) // TIME_ENTRY.size * TIME_ENTRY.size].cast('q')
+        stamps, offsets = times[0::2], times[1::2]
+        block = max(bisect_right(stamps, start) - 1, 0)
+        offset = offsets[block] if block < len(offsets) else len(data)
+        while offset + size <= len(data):
+            fields = unpack(data, offset)
+            stamp, source, length = fields[0], fields[1], fields[6]
+            if stamp > end:
+                return
+            if stamp >= start and (src is None or source == src):
+                yield packet(offset)
+            offset += size + length
+
+class PacketStore:
+    """Append-only, indexed packet store in directory
+
+A new segment is started every segment_bytes of data or segment_age
+seconds; segments entirely older than retention seconds are deleted,
+as are the oldest ones once the store outgrows max_bytes."""
+    def __init__(self, directory, segment_bytes=64 << 20, segment_age=3600,
+                 retention=None, max_bytes=None, buffering=1 << 16):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.buffering = buffering
+        self.stored = 0
+        os.makedirs(directory, exist_ok=True)
+        self.segments = [
+            Segment(directory, int(name[:-4]))
+            for name in sorted(os.listdir(directory)) if name.endswith('.dat')
+        ]
+        self._lock = threading.Lock()
+        self._files = None
+        self._count = 0
+        for older, newer in zip(self.segments, self.segments[1:]):
+            older.end = newer.start
+        self._last = self.segments[-1].last_stamp() if self.segments else 0
+    def close(self):
+        "flush and close the current segment"
+        with self._lock:
+            self._close_segment()
+    def _close_segment(self):
+        if self._files:
+            for file in self._files:
+                file.close()
+            self._files = None
+            segment = self.segments[-1]
+            segment.write_sources(segment.sources)
+            segment.sources = None
+    def _open_segment(self, stamp):
+        self._close_segment()
+        segment = Segment(self.directory, stamp)
+        segment.sources = {}
+        if self.segments:
+            self.segments[-1].end = stamp
+        self.segments.append(segment)
+        data, times, _ = segment.paths()
+        self._files = (
+            open(data, 'xb', buffering=self.buffering),
+            open(times, 'xb', buffering=self.buffering),
+        )
+        self._files[0].write(MAGIC)
+        self._count = 0
+        self._expire(stamp)
+    def _expire(self, stamp):
+        if self.retention is not None:
+            while len(self.segments) > 1 and self.segments[1].start < stamp - self.retention * 1e6:
+                self.segments.pop(0).remove()
+        if self.max_bytes is not None:
+            while len(self.segments) > 1 and sum(s.size() for s in self.segments) > self.max_bytes:
+                self.segments.pop(0).remove()
+    def append(self, packet, timestamp=None):
+        "store an RxPacket at timestamp, by default when it was received, or now"
+        if timestamp is None:
+            timestamp = getattr(packet, 'timestamp', None)
+        stamp = int((time.time() if timestamp is None else timestamp) * 1e6)
+        if packet.protocol == 1:
+            src, dst = 0, packet.port
+        else:
+            src, dst = packet.src, packet.dst
+        data = packet.data
+        with self._lock:
+            stamp = self._last = max(stamp, self._last)
+            if self._files is None or self._files[0].tell() >= self.segment_bytes or \
+                stamp - self.segments[-1].start >= self.segment_age * 1e6:
+                if self.segments and stamp <= self.segments[-1].start:
+                    # segments are named after their start: never reuse a name
+                    stamp = self._last = self.segments[-1].start + 1
+                self._open_segment(stamp)
+            data_file, time_file = self._files
+            offset = data_file.tell()
+            if self._count % BLOCK == 0:
+                time_file.write(TIME_ENTRY.pack(stamp, offset))
+            sources = self.segments[-1].sources
+            if src not in sources:
+                sources[src] = array('I')
+            sources[src].append(offset)
+            data_file.write(RECORD.pack(stamp, src, dst, packet.rssi, packet.options,
+                                        packet.protocol, len(data)))
+            data_file.write(data)
+            self._count += 1
+            self.stored += 1
+    def flush(self):
+        "push buffered packets to disk, data before indexes"
+        with self._lock:
+            if self._files:
+                for file in self._files:
+                    file.flush()
+    def query(self, start=None, end=None, src=None):
+        "packets received from start to end (time.time() seconds), from src if given"
+        self.flush()
+        start = 0 if start is None else int(start * 1e6)
+        end = (1 << 63) - 1 if end is None else int(end * 1e6)
+        with self._lock:
+            segments = [
+                s for s in self.segments if s.start <= end and (s.end is None or s.end >= start)
+            ]
+        packets = []
+        for segment in segments:
+            packets.extend(segment.query(start, end, src))
+        return packets
+    def follow(self, ebi, protocol=0):
+        "store every packet ebi receives, from a thread running until ebi is closed"
+        def run():
+            for packet in ebi.packets(protocol):
+                self.append(packet)
+        thread = threading.Thread(target=run, name=f"store {ebi.dev}", daemon=True)
+        thread.start()
+        return thread
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} directory [src] [seconds]")
+        sys.exit(1)
+    STORE = PacketStore(sys.argv[1])
+    SRC = int(sys.argv[2], 0) if len(sys.argv) > 2 else None
+    SINCE = time.time() - float(sys.argv[3]) if len(sys.argv) > 3 else None
+    BEGIN = time.perf_counter()
+    PACKETS = STORE.query(start=SINCE, src=SRC)
+    ELAPSED = time.perf_counter() - BEGIN
+    for PACKET in PACKETS:
+        WHEN = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(PACKET.timestamp))
+        print(f"{WHEN} src {PACKET.src:04x} dst {PACKET.dst:04x} rssi {PACKET.rssi} {PACKET.data}")
+    print(f"{len(PACKETS)} packets in {ELAPSED * 1000:.1f} ms")